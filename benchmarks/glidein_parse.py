@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Benchmark parsing of a synthetic pyglidein status page.
+
+Compares the streaming extraction against the old objectify parse,
+which ran `cssselect` (and so translated CSS to XPath again) three
+times per client div, and against a full-tree parse with the
+precompiled selectors.  All of them must find the same clients.
+"""
+import os
+import sys
+import random
+import timeit
+from datetime import datetime, timedelta
+from argparse import ArgumentParser
+
+from lxml import html, objectify
+from lxml.cssselect import CSSSelector
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..','glidein_monitor'))
+from glidein import iter_clients, uuid_selector, date_selector
+
+
+def reference(content):
+    """The parse as it was in glidein.monitor"""
+    ret = []
+    root = objectify.fromstring(content, parser=html.HTMLParser())
+    for e in root.body.cssselect('div.clients div'):
+        if not e.cssselect('span.uuid'):
+            continue
+        uuid = e.cssselect('span.uuid')[0].text
+        date_raw = e.cssselect('span.date')[0].text
+        ret.append((uuid, date_raw))
+    return ret
+
+client_selector = CSSSelector('div.clients div')
+
+def compiled(content):
+    """Full-tree parse with the precompiled selectors"""
+    ret = []
+    root = html.fromstring(content)
+    for e in client_selector(root):
+        uuid = uuid_selector(e)
+        if uuid:
+            ret.append((uuid[0].text, date_selector(e)[0].text))
+    return ret
+
+def streaming(content, size=65536):
+    chunks = (content[i:i+size] for i in range(0, len(content), size))
+    return list(iter_clients(chunks))
+
+
+def make_page(clients):
+    """Make a status page listing `clients` glidein clients"""
+    sites = ['GZK9000','CHTC','UMD','DESY','Bartol','UW-Madison','Brussels']
+    now = datetime(2017,6,12,12,0,0)
+    lines = ['<html><head><title>pyglidein</title></head><body>',
+             '<h1>pyglidein server</h1>',
+             '<div class="queue"><div><span class="uuid">not-a-client</span>'
+             '<span class="date">2017-06-12 12:00:00</span></div></div>',
+             '<div class="clients">',
+             '<div class="header"><span>uuid</span><span>last seen</span></div>']
+    for i in range(clients):
+        date = now-timedelta(seconds=random.randint(0,40*86400))
+        lines.append('<div class="client"><span class="uuid">%s-%06d</span> '
+                     '<span class="date">%s</span> <span class="jobs">%d</span>'
+                     '</div>'%(random.choice(sites), i,
+                               date.strftime('%Y-%m-%d %H:%M:%S'),
+                               random.randint(0,500)))
+    lines.append('</div></body></html>')
+    return '\n'.join(lines).encode('utf-8')
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    random.seed(1)
+    content = make_page(args.clients)
+    print('page: %d clients, %.1f MB'%(args.clients, len(content)/1e6))
+
+    funcs = [('reference', reference), ('compiled', compiled),
+             ('streaming', streaming)]
+    expected = reference(content)
+    if len(expected) != args.clients:
+        raise Exception('reference found %d clients'%len(expected))
+    for name,func in funcs[1:]:
+        if func(content) != expected:
+            raise Exception('%s mismatch'%name)
+
+    for name,func in funcs:
+        t = min(timeit.repeat(lambda: func(content), number=1,
+                              repeat=args.repeat))
+        print('%-10s %8.3f s  %8.0f clients/s'%(name, t, args.clients/t))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Check and benchmark the RFC 2047 header decoder.
+
+The test vectors are written to look like the sender names and
+subjects in the grid-logbook pipermail archives, from mail clients in
+several languages.  They are not copied from the archives: those sit
+behind the collaboration login and hold people's addresses, so they
+cannot be checked in here.  The vectors are checked first, including
+whole messages with folded headers, then the decoder is timed against
+the old one on headers of increasing length.
+"""
+import os
+import sys
+import timeit
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..','grid_logbook'))
+from headers import decode_header, legacy_decode_header as reference_decode_header
+from mailinglist import parse_msg
+
+vectors = [
+    # plain headers pass through
+    ('GZK9000 glideins failing', 'GZK9000 glideins failing'),
+    ('jdoe at icecube.wisc.edu', 'jdoe at icecube.wisc.edu'),
+    # single Q and B words
+    ('=?utf-8?Q?Ren=C3=A9_Dubois?=', 'René Dubois'),
+    ('=?UTF-8?B?SsO2cmcgSMOkbmRlbA==?=', 'Jörg Händel'),
+    ('=?iso-8859-1?Q?J=F6rg_H=E4ndel?=', 'Jörg Händel'),
+    # text around an encoded word
+    ('Re: =?utf-8?Q?Wartung_M=C3=BCnchen?= tonight', 'Re: Wartung München tonight'),
+    # whitespace between adjacent encoded words is dropped
+    ('=?utf-8?Q?CHTC_jobs?= =?utf-8?Q?_held_at_M=C3=BCnchen?=',
+     'CHTC jobs held at München'),
+    ('=?utf-8?B?R3JpZA==?=\n =?utf-8?B?IE9wcw==?=', 'Grid Ops'),
+    # a character split across two words
+    ('=?utf-8?B?w6k=?= =?utf-8?Q?t=C3?= =?utf-8?Q?=A9?=', 'été'),
+    # mixed charsets in one header
+    ('=?iso-8859-1?Q?Andr=E9?= and =?koi8-r?B?8NLJ18XU?=', 'André and Привет'),
+    ('=?utf-8?Q?=E6=97=A5=E6=9C=AC?= =?iso-8859-2?Q?=B3=F3d=BF?=', '日本łódż'),
+    # lower case method letters and a language tag
+    ('=?utf-8?q?caf=C3=A9?=', 'café'),
+    ('=?utf-8*en?Q?disk_quota?=', 'disk quota'),
+    # missing base64 padding
+    ('=?utf-8?B?RGlzayBmdWxs?=', 'Disk full'),
+    ('=?utf-8?B?RGlzayBmdWxsIQ?=', 'Disk full!'),
+    # unknown charsets and malformed words are left readable
+    ('=?x-unknown?Q?site_down?=', 'site down'),
+    ('=?utf-8?B?#bad#?= rest', '=?utf-8?B?#bad#?= rest'),
+    ('50% of jobs =? not encoded', '50% of jobs =? not encoded'),
+]
+
+# whole messages, as parse_msg sees them
+message_vectors = [
+    # a subject folded between two encoded words
+    ('From: jdoe at icecube.wisc.edu (=?utf-8?Q?J=C3=B6rg_H=C3=A4ndel?=)\n'
+     'Date: Mon, 05 Jun 2017 10:00:00 -0500\n'
+     'Subject: [grid-logbook] =?utf-8?Q?Wartung_in_M=C3=BCnchen?=\n'
+     ' =?utf-8?Q?_heute_Nacht?=\n'
+     'Message-ID: <1@icecube.wisc.edu>\n'
+     '\n'
+     'body\n',
+     'From: Jörg Händel\n'
+     'Date: 2017-06-05T15:00:00 UTC\n'
+     'Subject: Wartung in München heute Nacht\n'
+     '\nbody'),
+    # plain text folded with a tab, and a folded From
+    ('From: jdoe at icecube.wisc.edu\n'
+     '\t(John Doe)\n'
+     'Subject: [grid-logbook] GZK9000 glideins failing\n'
+     '\tat several sites\n'
+     '\n'
+     'body\n',
+     'From: John Doe\n'
+     'Subject: GZK9000 glideins failing at several sites\n'
+     '\nbody'),
+]
+
+def long_header(words):
+    """A subject with `words` words, Q-encoded in one long word"""
+    text = ' '.join('München-%d'%i for i in range(words)).encode('utf-8')
+    return '=?utf-8?Q?'+''.join(chr(b) if chr(b).isalnum() and b < 128
+                                else '=%02X'%b for b in text)+'?='
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=20)
+    args = parser.parse_args()
+
+    failed = 0
+    for raw,expected in vectors:
+        got = decode_header(raw)
+        if got != expected:
+            print('FAIL %r -> %r, expected %r'%(raw, got, expected))
+            failed += 1
+    for raw,expected in message_vectors:
+        got = parse_msg(raw)
+        if got != expected:
+            print('FAIL %r -> %r, expected %r'%(raw, got, expected))
+            failed += 1
+    total = len(vectors)+len(message_vectors)
+    print('%d/%d test vectors passed'%(total-failed, total))
+    if failed:
+        sys.exit(1)
+
+    for words in (10, 100, 1000, 10000):
+        header = long_header(words)
+        if decode_header(header) != reference_decode_header(header):
+            raise Exception('decoders disagree')
+        row = ['%6d bytes'%len(header)]
+        for name,func in (('reference',reference_decode_header),
+                          ('decoder',decode_header)):
+            t = min(timeit.repeat(lambda: func(header), number=args.number,
+                                  repeat=3))/args.number
+            row.append('%s %9.1f us'%(name, t*1e6))
+        print('  '.join(row))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Benchmark json_store load/store throughput on datetime-heavy stores.
+
+Each entry looks like a glidein site record.  For every store size this
+times a full store, a load, and a journaled store after changing 1% of
+the entries (passing the changed keys, as the glidein monitor does) or
+none of them, and compares the load against the old converter path
+(strptime parsing plus a log call per tagged object).
+"""
+import os
+import sys
+import json
+import shutil
+import logging
+import tempfile
+import timeit
+from datetime import datetime, date, time, timedelta
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import json_store
+from json_store import load, store, JSONConverters
+
+
+def reference_JSONToObj(obj):
+    """The decoder as it was before the fast path"""
+    def parse(obj):
+        if ':' in obj:
+            if 'T' in obj or ' ' in obj:
+                center = 'T' if 'T' in obj else ' '
+                if '.' in obj:
+                    return datetime.strptime(obj, "%Y-%m-%d"+center+"%H:%M:%S.%f")
+                return datetime.strptime(obj, "%Y-%m-%d"+center+"%H:%M:%S")
+            if '.' in obj:
+                return datetime.strptime(obj, "%H:%M:%S.%f")
+            return datetime.strptime(obj, "%H:%M:%S")
+        return datetime.strptime(obj, "%Y-%m-%d")
+    ret = obj
+    if isinstance(obj,dict) and '__jsonclass__' in obj:
+        logging.info('try unpacking class')
+        name, value = obj['__jsonclass__']
+        d = parse(value)
+        if name == 'date':
+            ret = date(d.year,d.month,d.day)
+        elif name == 'time':
+            ret = time(d.hour,d.minute,d.second,d.microsecond)
+        elif name == 'set':
+            ret = set(value)
+        else:
+            ret = d
+    return ret
+
+def make_store(n):
+    start = datetime(2017,6,1,12,0,0,123456)
+    return {'site-%07d'%i: {
+                'date': start+timedelta(seconds=i),
+                'first_seen': (start-timedelta(days=i%30)).date(),
+                'heartbeat': (start+timedelta(microseconds=i)).time(),
+                'status': 'OK' if i%10 else 'FAILED',
+            } for i in range(n)}
+
+def best(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--max', type=int, default=5,
+                        help='largest store is 10^max entries (up to 6)')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # the old decoder logged at info for every object
+    logging.basicConfig(level='INFO', stream=open(os.devnull,'w'))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'store')
+        print('%9s %10s %10s %10s %12s %14s'%('entries','store','load',
+              'old load','journal 1%','journal none'))
+        for exp in range(3, args.max+1):
+            n = 10**exp
+            data = make_store(n)
+            def full_store():
+                # forget the last digest, or repeats skip the write
+                json_store._digests.clear()
+                store(data, filename)
+            t_store = best(full_store, args.repeat)
+            t_load = best(lambda: load(filename), args.repeat)
+            if load(filename) != data:
+                raise Exception('round trip failed')
+            def old_load():
+                with open(filename) as f:
+                    return json.load(f, object_hook=reference_JSONToObj)
+            t_old = best(old_load, args.repeat)
+
+            jfile = filename+'-journal'
+            store(data, jfile, journal=True)
+            keys = sorted(data)[::100]
+            # pass the changed keys, as SiteState does
+            def journal_change():
+                for k in keys:
+                    data[k]['date'] += timedelta(seconds=1)
+                store(data, jfile, journal=True, changed=keys)
+            t_journal = best(journal_change, args.repeat)
+            t_unchanged = best(lambda: store(data, jfile, journal=True,
+                                             changed=()), args.repeat)
+            if load(jfile) != data:
+                raise Exception('journal round trip failed')
+            print('%9d %9.3fs %9.3fs %9.3fs %11.3fs %13.3fs'%(n, t_store,
+                  t_load, t_old, t_journal, t_unchanged))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Benchmark parsing of a synthetic mailing-list month archive.
+
+Compares the streaming parser against the old parser, which loaded
+the whole month into one string and built each message with `+=`.
+Both must produce the same message hashes.
+"""
+import os
+import io
+import re
+import sys
+import time
+import random
+import tracemalloc
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..','grid_logbook'))
+from mailinglist import hash, decode_header, iter_lines, iter_messages
+
+
+def reference_parse_msg(text):
+    process_header = True
+    sender = None
+    date = None
+    subject = None
+    body = ''
+    for line in text.split('\n'):
+        line = line.strip()
+        if process_header:
+            if not line:
+                process_header = False
+            elif line.startswith('From:'):
+                val = line.split(':',1)[1].strip().replace(' at ','@')
+                if '(' in val and ')' in val:
+                    val = val.split('(',1)[1].rsplit(')',1)[0].strip()
+                sender = decode_header(val)
+            elif line.startswith('Date:'):
+                from datetime import datetime
+                val = line.split(':',1)[1].strip()
+                d = datetime.strptime(val, '%a, %d %b %Y %H:%M:%S %z')
+                val = (d - d.utcoffset()).replace(tzinfo=None).isoformat()
+                date = val+' UTC'
+            elif line.startswith('Subject:'):
+                val = line.split(':',1)[1].replace('[grid-logbook]','').strip()
+                subject = decode_header(val)
+        elif line.startswith('-------------- next part --------------'):
+            break
+        else:
+            body += line+'\n'
+    ret = ''
+    if sender:
+        ret += 'From: '+sender+'\n'
+    if date:
+        ret += 'Date: '+date+'\n'
+    if subject:
+        ret += 'Subject: '+subject+'\n'
+    if body:
+        ret += '\n'+body.strip()
+    return ret
+
+def reference_parse_month(text):
+    """The parser as it was before streaming"""
+    buffer = ''
+    ret = []
+    for line in text.split('\n'):
+        if re.match(r'From \w*.\w* at \w*.\w*.\w* *\w*',line) and buffer:
+            msg = reference_parse_msg(buffer)
+            ret.append({'hash':hash(msg), 'text':msg})
+            buffer = ''
+        else:
+            buffer += line+'\n'
+    if buffer:
+        msg = reference_parse_msg(buffer)
+        ret.append({'hash':hash(msg), 'text':msg})
+    return ret
+
+
+def make_archive(size_mb):
+    """Make a month archive of about `size_mb` megabytes"""
+    sites = ['GZK9000','CHTC','UMD','DESY','Bartol','UW-Madison','Brussels']
+    users = ['jdoe at icecube.wisc.edu (John Doe)',
+             'asmith at physik.uni-wuppertal.de (Alice Smith)',
+             'ops at gridmon.example.org (=?utf-8?Q?Grid_Ops_M=C3=BCnchen?=)']
+    out = []
+    size = 0
+    n = 0
+    while size < size_mb*1e6:
+        n += 1
+        site = random.choice(sites)
+        lines = [
+            'From %s  Mon Jun  5 %02d:%02d:00 2017'%(random.choice(users).split(' (')[0],
+                                                     n%24, n%60),
+            'From: '+random.choice(users),
+            'Date: Mon, 05 Jun 2017 %02d:%02d:00 -0500'%(n%24, n%60),
+            'Subject: [grid-logbook] %s glideins failing (%d)'%(site, n),
+            'Message-ID: <%d.%s at icecube.wisc.edu>'%(n, site),
+            '',
+        ]
+        for _ in range(random.randint(5,200)):
+            lines.append('%s: job %d held, reason: %s'%(
+                site, random.randint(1e6,1e7),
+                random.choice(['memory exceeded','disk quota','wall time','lost contact'])))
+        lines.append('-------------- next part --------------')
+        lines.append('An HTML attachment was scrubbed...')
+        lines.append('')
+        msg = '\n'.join(lines)+'\n'
+        out.append(msg)
+        size += len(msg)
+    return ''.join(out).encode('utf-8')
+
+def chunked(data, size=65536):
+    f = io.BytesIO(data)
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def run(name, func):
+    tracemalloc.start()
+    start = time.time()
+    hashes = func()
+    t = time.time()-start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return name, t, peak, hashes
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=float, default=20,
+                        help='archive size in MB')
+    args = parser.parse_args()
+
+    random.seed(1)
+    data = make_archive(args.size)
+    mb = len(data)/1e6
+    print('archive: %.1f MB'%mb)
+
+    def reference():
+        return [m['hash'] for m in reference_parse_month(data.decode('utf-8'))]
+    def streaming():
+        return [m['hash'] for m in iter_messages(iter_lines(chunked(data)))]
+
+    results = [run('reference', reference), run('streaming', streaming)]
+    if results[0][3] != results[1][3]:
+        raise Exception('parsers disagree')
+    print('%d messages'%len(results[0][3]))
+    for name,t,peak,_ in results:
+        print('%-10s %7.2f s  %7.1f MB/s  peak mem %7.1f MB'%(name, t, mb/t, peak/1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Check the slack outbound queue and spool against a fake Slack client.
+
+The fake client records every post and acks it, or holds the acks
+back when told to.  The checks are:
+
+  - messages to a channel arrive in the order they were queued
+  - a message split into several posts is only marked done in the
+    spool once every part is acked
+  - after a crash with unacked posts, a restart sends them again and
+    leaves nothing unfinished in the spool
+
+Then it measures how many posts a burst of alerts coalesces into, and
+how many fsyncs the spool group commit needs for writes from many
+threads.  The post count only depends on the message sizes; the fsync
+count depends on how fast the disk syncs.
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import slack
+
+
+class FakeServer:
+    username = 'bot'
+    login_data = {'self':{'id':'U1'}}
+
+    def __init__(self):
+        self.posts = [] # (time, channel, text) in write order
+        self.unread = [] # ids written but not read back yet
+        self.held = [] # ids with acks held back
+        self.hold = False
+        self.lock = threading.Lock()
+
+    def send_to_websocket(self, data):
+        with self.lock:
+            self.posts.append((time.time(), data['channel'], data['text']))
+            (self.held if self.hold else self.unread).append(data['id'])
+
+    def release(self, count=None):
+        """Ack the first `count` held posts, or all of them"""
+        with self.lock:
+            if count is None:
+                count = len(self.held)
+            self.unread.extend(self.held[:count])
+            self.held = self.held[count:]
+
+    def ping(self):
+        pass
+
+class FakeClient:
+    def __init__(self, token):
+        self.server = FakeServer()
+
+    def rtm_connect(self, **kwargs):
+        return True
+
+    def rtm_read(self):
+        with self.server.lock:
+            ids, self.server.unread = self.server.unread, []
+        return [{'ok':True, 'reply_to':i} for i in ids]
+
+    def api_call(self, method, **kwargs):
+        return {'ok':True, 'channels':[{'name':'general', 'id':'CGENERAL'}]}
+
+def wait_for(cond, timeout=10):
+    end = time.time()+timeout
+    while not cond():
+        if time.time() > end:
+            return False
+        time.sleep(0.01)
+    return True
+
+def bot(**kwargs):
+    args = {'delay':0.05, 'coalesce':0.2, 'rate':100, 'burst':100}
+    args.update(kwargs)
+    return slack.SlackMessage('token', **args)
+
+def check_order():
+    """Messages of all sizes come out in order"""
+    m = bot(max_length=500, spool=None)
+    expected = []
+    for i in range(200):
+        lines = ['msg-%04d'%i]+['line %d of %d'%(j,i) for j in range(i%60)]
+        m.send_message('general', '\n'.join(lines))
+        expected.append('msg-%04d'%i)
+        if i%50 == 0:
+            time.sleep(0.3) # let a few posts go out in between
+    if not m.flush(30):
+        return 'not all acked'
+    posts = m.client.server.posts
+    if any(len(text) > 500 for _,_,text in posts):
+        return 'post longer than max_length'
+    got = [w for _,_,text in posts for w in text.split() if w.startswith('msg-')]
+    if got != expected:
+        return 'out of order'
+    return None
+
+def check_split_done():
+    """A split message is done only after all its parts are acked"""
+    m = bot(max_length=100, ack_timeout=60)
+    server = m.client.server
+    server.hold = True
+    m.send_message('general', '\n'.join('part line %d'%i for i in range(30)))
+    if not wait_for(lambda: len(server.held) >= 3):
+        return 'not split'
+    parts = len(server.held)
+    (spool_id,) = m.spool.outstanding
+    for i in range(parts-1):
+        server.release(1)
+        time.sleep(0.3)
+        if spool_id not in m.spool.outstanding:
+            return 'done after %d of %d parts'%(i+1, parts)
+    server.release()
+    if not m.flush(10):
+        return 'not all acked'
+    if m.spool.outstanding:
+        return 'not done after all parts'
+    return None
+
+def check_replay():
+    """Unacked messages survive a crash and finish after a restart"""
+    m = bot(ack_timeout=60)
+    m.client.server.hold = True
+    msgs = ['alert %d'%i for i in range(20)]
+    for msg in msgs:
+        m.send_message('general', msg)
+    if not wait_for(lambda: len(m.client.server.held) >= 1):
+        return 'nothing posted'
+    # crash: the first bot never hears its acks, and the spool ends
+    # in a torn write
+    with open('.slack_spool', 'a') as f:
+        f.write('{"id": 99, "chan')
+    m2 = bot()
+    if not m2.flush(10):
+        return 'replay not acked'
+    got = '\n'.join(text for _,_,text in m2.client.server.posts).split('\n')
+    if got != msgs:
+        return 'replayed %r'%got
+    left = slack.Spool('.slack_spool').replay()
+    if left:
+        return '%d messages unfinished after replay'%len(left)
+    return None
+
+def measure_coalesce(alerts):
+    """Alerts queued in a burst, with the default rate and post size"""
+    m = slack.SlackMessage('token', spool=None, coalesce=2)
+    start = time.time()
+    for i in range(alerts):
+        m.send_message('general', 'grid-logbook: ```message %d %s```'%(i,
+                       'x'*250))
+    if not m.flush(120):
+        raise Exception('alerts not acked')
+    return len(m.client.server.posts), time.time()-start
+
+def measure_fsyncs(threads, adds):
+    """Spool adds from many threads at once"""
+    fsyncs = [0]
+    real_fsync = os.fsync
+    def fsync(fd):
+        fsyncs[0] += 1
+        real_fsync(fd)
+    spool = slack.Spool('.fsync_spool')
+    spool.replay()
+    def writer():
+        for _ in range(adds//threads):
+            spool.add('general', 'x'*100)
+    workers = [threading.Thread(target=writer) for _ in range(threads)]
+    os.fsync = fsync
+    try:
+        start = time.time()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        elapsed = time.time()-start
+    finally:
+        os.fsync = real_fsync
+    return fsyncs[0], elapsed
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--alerts', type=int, default=300)
+    parser.add_argument('--threads', type=int, default=20)
+    parser.add_argument('--adds', type=int, default=1000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level='CRITICAL')
+    slack.SlackClient = FakeClient
+
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    os.chdir(tmpdir)
+    try:
+        failed = 0
+        for check in (check_order, check_split_done, check_replay):
+            for f in os.listdir('.'):
+                os.remove(f)
+            error = check()
+            if error:
+                print('FAIL %s: %s'%(check.__doc__, error))
+                failed += 1
+            else:
+                print('ok   %s'%check.__doc__)
+        if failed:
+            sys.exit(1)
+
+        posts, elapsed = measure_coalesce(args.alerts)
+        print('%d alerts -> %d posts in %.1fs'%(args.alerts, posts, elapsed))
+        fsyncs, elapsed = measure_fsyncs(args.threads, args.adds)
+        print('%d spool adds from %d threads -> %d fsyncs in %.2fs'%(
+              args.adds, args.threads, fsyncs, elapsed))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
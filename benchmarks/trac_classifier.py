@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Benchmark the trac ticket classifier on long pasted descriptions.
+
+Compares against the old per-keyword scans (which lowercased the whole
+text for every keyword) and a single-pass regex alternation over all
+keywords, and checks that all of them give the same answer.
+"""
+import os
+import re
+import sys
+import random
+import timeit
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..','trac_ticket'))
+from trac import TicketConstants, TicketClassifier
+
+
+def reference(summary, description):
+    """The per-keyword scans that new_ticket used to do"""
+    def locate(phrases):
+        s = summary.lower()+description.lower()
+        return any(p in s for p in phrases)
+
+    def find_phrase(phrases, valid=None):
+        for phrase in phrases:
+            pos = description.find(phrase)
+            if pos >= 0:
+                pos += len(phrase)
+                while pos < len(description) and description[pos] == ' ':
+                    pos += 1
+                pos2 = description.find(' ',pos)
+                if pos2 > 0:
+                    ret = description[pos:pos2]
+                else:
+                    ret = description[pos:]
+                if valid:
+                    ret = ret.lower()
+                    if ret not in valid:
+                        continue
+                return ret
+        return None
+
+    ret = {'type':None, 'priority':None, 'component':None, 'owner':None}
+    for t in TicketConstants['type']:
+        if locate([t]):
+            ret['type'] = t
+            break
+    else:
+        if locate(['bug','fix','error','broke']):
+            ret['type'] = 'defect'
+        elif locate(['idea','what if','new','feature']):
+            ret['type'] = 'enhancement'
+        elif locate(['todo','cleanup','clean up']):
+            ret['type'] = 'cleanup'
+    for p in TicketConstants['priority']:
+        if locate([p]):
+            ret['priority'] = p
+            break
+    for c in TicketConstants['component']:
+        if locate([c]):
+            ret['component'] = c
+            break
+    else:
+        ret['component'] = find_phrase(['component:','component to'],
+                                       valid=TicketConstants['component'])
+    ret['owner'] = find_phrase(['owner:','owner to'])
+    return ret
+
+
+class RegexClassifier(TicketClassifier):
+    """One regex pass over the text, finding overlapping matches"""
+    def __init__(self, constants=TicketConstants):
+        super(RegexClassifier, self).__init__(constants)
+        terms = set(constants['type']+constants['priority']+constants['component'])
+        for _,words in self.fallback_types:
+            terms.update(words)
+        alternation = '|'.join(re.escape(t) for t in
+                               sorted(terms, key=len, reverse=True))
+        self.term_re = re.compile(alternation)
+        # shorter terms hidden by a longer match at the same position
+        self.prefixes = {t:[p for p in terms if p != t and t.startswith(p)]
+                         for t in terms}
+
+    def classify(self, summary, description):
+        text = summary.lower()+description.lower()
+        found = set()
+        pos = 0
+        while True:
+            m = self.term_re.search(text, pos)
+            if not m:
+                break
+            found.add(m.group(0))
+            found.update(self.prefixes[m.group(0)])
+            pos = m.start()+1
+        ret = {'type':None, 'priority':None, 'component':None}
+        for value,words in self.type_rules:
+            if any(w in found for w in words):
+                ret['type'] = value
+                break
+        for value in self.priorities:
+            if value in found:
+                ret['priority'] = value
+                break
+        for value in self.components:
+            if value in found:
+                ret['component'] = value
+                break
+        else:
+            ret['component'] = self.find_value(description,
+                    ['component:','component to'], valid=self.valid_components)
+        ret['owner'] = self.find_value(description, ['owner:','owner to'])
+        return ret
+
+
+def stack_trace(depth):
+    lines = ['Traceback (most recent call last):']
+    for i in range(depth):
+        lines.append('  File "/data/user/sim/icetray/src/module%d.py", line %d, in run_%d'
+                     %(i, random.randint(1,5000), i))
+        lines.append('    result = self.process(frame, keys=%r)'%(['I3MCTree','SRTPulses'],))
+    lines.append('RuntimeError: segmentation violation in I3Reader')
+    return lines
+
+def log_lines(count):
+    levels = ['INFO','WARN','DEBUG','NOTICE']
+    return ['2017-06-%02d %02d:%02d:%02d %s (I3Tray): processed frame %d of run %d'
+            %(random.randint(1,30), random.randint(0,23), random.randint(0,59),
+              random.randint(0,59), random.choice(levels), i, random.randint(1e5,1e6))
+            for i in range(count)]
+
+def make_corpus(count, size):
+    """Make descriptions of roughly `size` lines"""
+    corpus = []
+    extras = ['', 'this is critical. ', 'owner: jdoe ', 'component: cmake ',
+              'component to simulation and owner to asmith ', 'what if we added a feature? ']
+    for _ in range(count):
+        lines = stack_trace(size//4)+log_lines(size//2)
+        random.shuffle(lines)
+        description = random.choice(extras)+'the job broke:\n'+'\n'.join(lines)
+        summary = description.split('. ',1)[0]
+        corpus.append((summary, description))
+    return corpus
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=50,
+                        help='number of descriptions')
+    parser.add_argument('--size', type=int, default=2000,
+                        help='lines per description')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(1)
+    corpus = make_corpus(args.count, args.size)
+    mb = sum(len(d) for _,d in corpus)/1e6
+    print('corpus: %d descriptions, %.1f MB'%(len(corpus), mb))
+
+    funcs = [
+        ('reference', reference),
+        ('regex', RegexClassifier().classify),
+        ('classifier', TicketClassifier().classify),
+    ]
+    for summary,description in corpus:
+        expected = reference(summary, description)
+        for name,func in funcs[1:]:
+            got = func(summary, description)
+            if got != expected:
+                raise Exception('%s mismatch: %r != %r'%(name, got, expected))
+
+    for name,func in funcs:
+        t = min(timeit.repeat(lambda: [func(s,d) for s,d in corpus],
+                              number=1, repeat=args.repeat))
+        print('%-10s %8.3f s  %8.1f MB/s'%(name, t, mb/t))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+../glidein_monitor/glidein.py
\ No newline at end of file
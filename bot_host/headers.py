@@ -0,0 +1 @@
+../grid_logbook/headers.py
\ No newline at end of file
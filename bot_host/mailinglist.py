@@ -0,0 +1 @@
+../grid_logbook/mailinglist.py
\ No newline at end of file
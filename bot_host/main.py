@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Run all the bots in one process, sharing a single slack connection.
+"""
+import os
+import json
+import logging
+import threading
+from functools import partial
+from argparse import ArgumentParser
+
+from setproctitle import setproctitle
+
+# per-monitor settings, overridden by the config file
+default_config = {
+    'updown': {
+        'enabled': True,
+        'channel': 'iceprod2',
+        'servers': [
+            'https://iceprod2.icecube.wisc.edu',
+            'https://sub-simprod-2.icecube.wisc.edu:9080',
+        ],
+    },
+    'glidein': {
+        'enabled': True,
+        'channel': 'pyglidein-sites',
+        'server': 'http://glidein-simprod.icecube.wisc.edu:11001',
+    },
+    'grid_logbook': {
+        'enabled': True,
+        'channel': 'pyglidein-sites',
+        'prefix': 'grid-logbook: ',
+        'archives': 'http://lists.icecube.wisc.edu/pipermail/grid-logbook/',
+        'http_auth': '.http_auth',
+    },
+    'trac_ticket': {
+        'enabled': True,
+    },
+    # options for the shared http_client session
+    'http': {
+        'timeout': 10,
+        'retries': 3,
+        'backoff': 0.5,
+    },
+}
+
+def load_config(filename):
+    """Merge the config file (if any) over the defaults"""
+    config = {k:dict(default_config[k]) for k in default_config}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            for name,settings in json.load(f).items():
+                if name not in config:
+                    raise Exception('unknown monitor %r in config'%name)
+                config[name].update(settings)
+    return config
+
+def start_updown(slack, cfg, testing=False):
+    from updown import monitor
+    send = partial(slack.send_message, cfg['channel'])
+    monitor([{'server':s,'send':send} for s in cfg['servers']])
+
+def start_glidein(slack, cfg, testing=False):
+    from glidein import monitor
+    monitor(server=cfg['server'],
+            send=partial(slack.send_message, cfg['channel']))
+
+def start_grid_logbook(slack, cfg, testing=False):
+    from mailinglist import monitor
+    if testing:
+        def send_message(msg):
+            pass
+    else:
+        def send_message(msg):
+            slack.send_message(cfg['channel'], cfg['prefix']+msg)
+    kwargs = {}
+    if os.path.exists(cfg['http_auth']):
+        for line in open(cfg['http_auth']).readlines():
+            if '=' in line:
+                key,value = [x.strip() for x in line.split('=',1)]
+                kwargs[key] = value
+    monitor(archives=cfg['archives'], send=send_message, **kwargs)
+
+monitors = {
+    'updown': start_updown,
+    'glidein': start_glidein,
+    'grid_logbook': start_grid_logbook,
+}
+
+def run_monitor(name, slack, cfg, testing=False):
+    try:
+        monitors[name](slack, cfg, testing=testing)
+    except Exception:
+        logging.error('%s monitor failed', name, exc_info=True)
+    logging.error('%s monitor has stopped', name)
+
+def main(config='.bot_host', testing=False, metrics_port=None,
+         profile=None):
+    from slack import SlackMessage
+    from tickets import TicketHandler
+    import http_client
+
+    setproctitle('bot_host')
+
+    logging.basicConfig(level='DEBUG' if testing else 'INFO',
+                        format='%(asctime)s %(threadName)s %(message)s')
+    if metrics_port:
+        import metrics
+        metrics.serve(metrics_port)
+    if profile:
+        import profiling
+        profiling.enable(profile)
+
+    config = load_config(config)
+    http_client.configure(**config['http'])
+
+    with open('.slack_token') as f:
+        token = f.read().strip()
+    handler = None
+    if config['trac_ticket']['enabled']:
+        handler = TicketHandler(testing=testing)
+    slack = SlackMessage(token, handler=handler, testing=testing)
+
+    for name in monitors:
+        if not config[name]['enabled']:
+            continue
+        t = threading.Thread(target=run_monitor, name=name,
+                             args=(name, slack, config[name]),
+                             kwargs={'testing':testing})
+        t.daemon = True
+        t.start()
+
+    if handler:
+        slack.run()
+        logging.error('SlackMessage has stopped')
+    else:
+        # no commands to answer, so just keep the monitors alive
+        for t in threading.enumerate():
+            if t.name in monitors:
+                t.join()
+    logging.error('bot host has stopped')
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--config', default='.bot_host',
+                        help='json file with per-monitor settings')
+    parser.add_argument('--testing', action='store_true',
+                        help='testing mode')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve prometheus metrics on this port')
+    parser.add_argument('--profile', nargs='?', const='profiles', default=None,
+                        metavar='DIR', help='profile each cycle, writing to DIR')
+
+    args = parser.parse_args()
+    main(config=args.config, testing=args.testing,
+         metrics_port=args.metrics_port, profile=args.profile)
@@ -0,0 +1 @@
+../slack.py
\ No newline at end of file
@@ -0,0 +1 @@
+../trac_ticket/tickets.py
\ No newline at end of file
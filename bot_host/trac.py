@@ -0,0 +1 @@
+../trac_ticket/trac.py
\ No newline at end of file
@@ -0,0 +1 @@
+../updown_monitor/updown.py
\ No newline at end of file
@@ -1,18 +1,208 @@
 import logging
 import time
+import heapq
 from datetime import datetime, timedelta
 import json
 
-from lxml import html, objectify
-import requests
+from lxml import etree
+from lxml.cssselect import CSSSelector
 
 from json_store import load, store
+from http_cache import PageCache
+import metrics
+import profiling
 
 logger = logging.getLogger('glidein')
 
+parse_seconds = metrics.histogram('parse_seconds', 'time to parse a fetched page')
+site_count = metrics.gauge('glidein_sites', 'number of sites being tracked')
+down_alerts = metrics.counter('glidein_down_alerts_total', 'sites reported down')
+
+# compiled once, evaluated relative to each client div
+uuid_selector = CSSSelector('span.uuid')
+date_selector = CSSSelector('span.date')
+
+def has_class(e, name):
+    return name in (e.get('class') or '').split()
+
+def iter_clients(chunks):
+    """
+    Stream (uuid, date) pairs out of a pyglidein status page.
+
+    Every div inside `div.clients` with a `span.uuid` gives one pair,
+    the same as selecting `div.clients div`.  Client divs are dropped
+    from the tree once read, so the whole page is never held at once.
+
+    Args:
+        chunks (iterable): the page as byte chunks
+
+    Returns:
+        generator of (uuid, date_raw) pairs
+    """
+    parser = etree.HTMLPullParser(events=('start','end'), tag='div')
+    clients = 0 # depth of div.clients nesting
+    def events():
+        for chunk in chunks:
+            parser.feed(chunk)
+            for event in parser.read_events():
+                yield event
+        parser.close()
+        for event in parser.read_events():
+            yield event
+    for event,e in events():
+        if event == 'start':
+            if has_class(e, 'clients'):
+                clients += 1
+            continue
+        if has_class(e, 'clients'):
+            clients -= 1
+        if not clients:
+            continue
+        uuid = uuid_selector(e)
+        if uuid:
+            yield uuid[0].text, date_selector(e)[0].text
+        parent = e.getparent()
+        if clients == 1 and has_class(parent, 'clients'):
+            e.clear(keep_tail=True)
+            while e.getprevious() is not None:
+                del parent[0]
+
+class SiteState:
+    """
+    Last-seen time and status of each glidein site.
+
+    A heap of (deadline, uuid) orders the sites by when they next need
+    attention: an OK site is down once it has not been seen for
+    `down_after`, and a failed site is dropped after `expire_after`.
+    Checking pops only the sites that are due.  Heap entries made stale
+    by a newer sighting are skipped when popped, and the heap is
+    rebuilt when they outnumber the live ones.
+
+    Saved state may be old: the first monitor kept sites forever and
+    only alerted for sites still on the page.  On load, expired sites
+    are dropped, and OK sites already overdue are marked down without
+    an alert unless the first page still lists them.
+
+    Args:
+        filename (str): json file to keep the state in
+        down_after (timedelta): time since last seen to call a site down
+        expire_after (timedelta): time since last seen to forget a site
+        now (datetime): current time, for aging the saved state
+    """
+    def __init__(self, filename='.sites', down_after=timedelta(hours=4),
+                 expire_after=timedelta(days=30), now=None):
+        self.filename = filename
+        self.down_after = down_after
+        self.expire_after = expire_after
+        self.sites = load(filename)
+        self.changed = set() # uuids to write on the next save
+        self.deleted = set() # uuids to remove on the next save
+        if now is None:
+            now = datetime.utcnow()
+        for uuid,site in list(self.sites.items()):
+            if site['date'] < now-self.expire_after:
+                del self.sites[uuid]
+                self.deleted.add(uuid)
+        if self.deleted:
+            logger.info('dropped %d expired sites', len(self.deleted))
+        # overdue at load, so down since before this run
+        self.stale = {uuid for uuid,site in self.sites.items()
+                      if site['status'] == 'OK' and
+                      site['date'] < now-self.down_after}
+        self._rebuild()
+
+    def __len__(self):
+        return len(self.sites)
+
+    def deadline(self, site):
+        if site['status'] == 'OK':
+            return site['date']+self.down_after
+        return site['date']+self.expire_after
+
+    def _rebuild(self):
+        self.deadlines = {uuid:self.deadline(site) for uuid,site in self.sites.items()}
+        self.heap = [(d,uuid) for uuid,d in self.deadlines.items()]
+        heapq.heapify(self.heap)
+
+    def _schedule(self, uuid):
+        d = self.deadline(self.sites[uuid])
+        if self.deadlines.get(uuid) != d:
+            self.deadlines[uuid] = d
+            heapq.heappush(self.heap, (d,uuid))
+            if len(self.heap) > 2*len(self.deadlines)+64:
+                self._rebuild()
+
+    def seen(self, uuid, date, now):
+        """
+        Record a site listed on the status page.
+
+        Args:
+            uuid (str): site uuid
+            date (datetime): when the server last heard from the site
+            now (datetime): current time
+        """
+        self.stale.discard(uuid) # still listed, so alert as usual
+        site = self.sites.get(uuid)
+        if site is None:
+            if date < now-self.expire_after:
+                return
+            self.sites[uuid] = {'date':date,'status':'OK'}
+        elif date <= site['date']:
+            return
+        else:
+            site['date'] = date
+            if site['status'] != 'OK' and date > now-self.down_after:
+                site['status'] = 'OK'
+        self.changed.add(uuid)
+        self.deleted.discard(uuid)
+        self._schedule(uuid)
+
+    def check(self, now, send):
+        """
+        Mark sites down and drop expired sites.
+
+        Args:
+            now (datetime): current time
+            send (func): function to send a message to
+        """
+        while self.heap and self.heap[0][0] <= now:
+            d,uuid = heapq.heappop(self.heap)
+            if self.deadlines.get(uuid) != d:
+                continue # superseded by a newer sighting
+            del self.deadlines[uuid]
+            site = self.sites[uuid]
+            # an OK site past expiry is too old to be news, so just drop it
+            if site['status'] == 'OK' and site['date'] >= now-self.expire_after:
+                if uuid in self.stale:
+                    logger.info('site %s was down before startup', uuid)
+                else:
+                    send('site *%s* is down. last heard from at %s'%(uuid,
+                         site['date'].strftime('%Y-%m-%d %H:%M:%S')))
+                    down_alerts.inc()
+                site['status'] = 'FAILED'
+                self._schedule(uuid)
+                self.changed.add(uuid)
+            else:
+                del self.sites[uuid]
+                self.changed.discard(uuid)
+                self.deleted.add(uuid)
+        self.stale = set() # only the first check after loading
+
+    def save(self):
+        if self.changed or self.deleted:
+            store(self.sites, self.filename, journal=True,
+                  changed=self.changed, deleted=self.deleted)
+            self.changed = set()
+            self.deleted = set()
+
 def monitor(server, send=lambda a:None, delay=60*5, failure_thresh=5):
     """
     Monitor a pyglidein server.
+
+    The page is fetched with a conditional request, and parsed as it
+    streams in unless the server answers 304.  Sites that went quiet
+    are still found on an unchanged page, since `SiteState` tracks them
+    by deadline.
     
     Args:
         server (str): address of pyglidein server
@@ -21,38 +211,30 @@ def monitor(server, send=lambda a:None, delay=60*5, failure_thresh=5):
         failure_thresh (int): number of page failures before error
     """
     main_failures = 0
-    sites = load('.sites')
+    state = SiteState()
+    pages = PageCache()
     while True:
-        final_cutoff = datetime.utcnow()-timedelta(days=30)
-        cutoff = datetime.utcnow()-timedelta(hours=4)
-        try:
-            r = requests.get(server, timeout=10)
-            r.raise_for_status()
-        except:
-            logger.warn('error getting server page', exc_info=True)
-            main_failures += 1
-            if main_failures > failure_thresh:
-                send('pyglidein server is down')
-        else:
+        with profiling.cycle('glidein'):
+            now = datetime.utcnow()
             try:
-                root = objectify.fromstring(r.content, parser=html.HTMLParser())
-                for e in root.body.cssselect('div.clients div'):
-                    if not e.cssselect('span.uuid'):
-                        continue
-                    uuid = e.cssselect('span.uuid')[0].text
-                    date_raw = e.cssselect('span.date')[0].text
-                    date = datetime.strptime(date_raw, '%Y-%m-%d %H:%M:%S')
-                    if date < final_cutoff:
-                        continue
-                    if uuid not in sites:
-                        sites[uuid] = {'date':date,'status':'OK'}
-                    elif sites[uuid]['status'] == 'OK' and date < cutoff:
-                        send('site *%s* is down. last heard from at %s'%(uuid,date_raw))
-                        sites[uuid] = {'date':date,'status':'FAILED'}
-                    elif sites[uuid]['status'] != 'OK' and date > cutoff:
-                        sites[uuid] = {'date':date,'status':'OK'}
-                store(sites, '.sites')
+                chunks = pages.fetch(server)
             except:
-                logger.warn('parsing error', exc_info=True)
+                logger.warn('error getting server page', exc_info=True)
+                main_failures += 1
+                if main_failures > failure_thresh:
+                    send('pyglidein server is down')
+            else:
+                try:
+                    if chunks is not None:
+                        with parse_seconds.time(monitor='glidein'):
+                            for uuid,date_raw in iter_clients(chunks):
+                                date = datetime.strptime(date_raw, '%Y-%m-%d %H:%M:%S')
+                                state.seen(uuid, date, now)
+                    state.check(now, send)
+                    state.save()
+                    site_count.set(len(state))
+                except:
+                    logger.warn('parsing error', exc_info=True)
+                    pages.forget(server)
 
         time.sleep(delay)
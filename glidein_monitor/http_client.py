@@ -0,0 +1 @@
+../http_client.py
\ No newline at end of file
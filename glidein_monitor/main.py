@@ -6,13 +6,19 @@ from argparse import ArgumentParser
 
 from setproctitle import setproctitle
 
-def main(testing=False):
+def main(testing=False, metrics_port=None, profile=None):
     from slack import SlackMessage
     from glidein import monitor
     
     setproctitle('glidein_monitor')
 
     logging.basicConfig(level='DEBUG' if testing else 'INFO')
+    if metrics_port:
+        import metrics
+        metrics.serve(metrics_port)
+    if profile:
+        import profiling
+        profiling.enable(profile)
     
     with open('.slack_token') as f:
         token = f.read().strip()
@@ -26,6 +32,11 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--testing', action='store_true',
                         help='testing mode')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve prometheus metrics on this port')
+    parser.add_argument('--profile', nargs='?', const='profiles', default=None,
+                        metavar='DIR', help='profile each cycle, writing to DIR')
 
     args = parser.parse_args()
-    main(testing=args.testing)
+    main(testing=args.testing, metrics_port=args.metrics_port,
+         profile=args.profile)
@@ -0,0 +1,116 @@
+"""
+Decode RFC 2047 encoded words in email headers.
+"""
+
+import re
+import base64
+import binascii
+
+# =?charset?encoding?encoded text?=
+encoded_word = re.compile(r'=\?([^?\s]+)\?([qQbB])\?([^?\s]*)\?=')
+
+def decode_word(method, text):
+    """
+    Decode the text of one encoded word to bytes.
+
+    Returns:
+        bytes: the raw bytes, or None if the text is malformed
+    """
+    try:
+        if method in 'qQ':
+            return binascii.a2b_qp(text.encode('ascii','replace'), header=True)
+        else:
+            text += '='*(-len(text)%4)
+            return base64.b64decode(text.encode('ascii','replace'), validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+def to_text(data, charset):
+    try:
+        return data.decode(charset, 'replace')
+    except LookupError:
+        return data.decode('latin-1')
+
+def legacy_decode_header(data):
+    """
+    Decode a header the way the first decoder did: only the first
+    encoded word, and raising on anything malformed.
+
+    Kept to recognise the hashes of messages recorded with it.
+    """
+    def quoted_printable(data,codec='utf8'):
+        ret = b''
+        oldpos = 0
+        pos = data.find('=')
+        while pos >= 0:
+            ret += data[oldpos:pos].encode(codec)
+            ret += base64.b16decode(data[pos+1:pos+3],True)
+            oldpos = pos+3
+            pos = data.find('=',oldpos)
+        ret += data[oldpos:].encode(codec)
+        return ret.decode(codec)
+    pos1 = data.find('=?')
+    pos2 = data.find('?=')
+    if pos1 >= 0 and pos2 > 0:
+        ret = data[:pos1]
+        parts = [x for x in data[pos1+2:pos2].split('?') if x]
+        codec = parts[0]
+        method = parts[1]
+        encoded_data = parts[2]
+        if method == 'Q':
+            ret += quoted_printable(encoded_data, codec)
+        else:
+            ret += base64.b64decode(encoded_data, True).decode(codec)
+        ret += data[pos2+2:]
+        return ret
+    else:
+        return data
+
+def decode_header(data):
+    """
+    Decode a header containing any number of encoded words.
+
+    Whitespace between adjacent encoded words is dropped, and adjacent
+    words in the same charset are joined before decoding, so characters
+    split across words come out whole.
+
+    Args:
+        data (str): raw header value
+
+    Returns:
+        str: decoded header value
+    """
+    if '=?' not in data:
+        return data
+    ret = []
+    pending = [] # bytes of adjacent words in one charset
+    charset = None
+    pos = 0
+    for m in encoded_word.finditer(data):
+        between = data[pos:m.start()]
+        if between and not (charset and between.isspace()):
+            if pending:
+                ret.append(to_text(b''.join(pending), charset))
+                pending = []
+            charset = None
+            ret.append(between)
+        raw = decode_word(m.group(2), m.group(3))
+        if raw is None:
+            # leave a malformed word as it was
+            if pending:
+                ret.append(to_text(b''.join(pending), charset))
+                pending = []
+            charset = None
+            ret.append(m.group(0))
+        else:
+            word_charset = m.group(1).split('*',1)[0].lower()
+            if pending and word_charset != charset:
+                ret.append(to_text(b''.join(pending), charset))
+                pending = []
+            charset = word_charset
+            pending.append(raw)
+        pos = m.end()
+    if pending:
+        ret.append(to_text(b''.join(pending), charset))
+    ret.append(data[pos:])
+    return ''.join(ret)
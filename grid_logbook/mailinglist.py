@@ -4,18 +4,30 @@ import time
 from datetime import datetime, timedelta
 import json
 import re
-import gzip
-import tempfile
+import zlib
+import codecs
+import itertools
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
 
 from lxml import html, objectify
-import requests
-from hashlib import sha512
-import base64
+from hashlib import sha1, sha512
 
-from json_store import load, store
+from json_store import JSONStore
+import http_client
+import metrics
+import profiling
+from headers import decode_header, legacy_decode_header
 
 logger = logging.getLogger('glidein')
 
+month_seconds = metrics.histogram('mailinglist_month_seconds',
+        'time to fetch, parse and send the new part of a month')
+messages_sent = metrics.counter('mailinglist_messages_sent_total',
+                                'messages sent to slack')
+
 def hash(text):
     """Hash some text"""
     m = sha512()
@@ -23,101 +35,292 @@ def hash(text):
     return m.hexdigest()
 
 
-def quoted_printable(data,codec='utf8'):
-    ret = b''
-    oldpos = 0
-    pos = data.find('=')
-    while pos >= 0:
-        ret += data[oldpos:pos].encode(codec)
-        ret += base64.b16decode(data[pos+1:pos+3],True)
-        oldpos = pos+3
-        pos = data.find('=',oldpos)
-    ret += data[oldpos:].encode(codec)
-    return ret.decode(codec)
-
-def decode_header(data):
-    pos1 = data.find('=?')
-    pos2 = data.find('?=')
-    if pos1 >= 0 and pos2 > 0:
-        # encoded
-        ret = data[:pos1]
-        parts = [x for x in data[pos1+2:pos2].split('?') if x]
-        codec = parts[0]
-        method = parts[1]
-        encoded_data = parts[2]
-        if method == 'Q':
-            ret += quoted_printable(encoded_data, codec)
-        else:
-            ret += base64.b64decode(encoded_data, True).decode(codec)
-        ret += data[pos2+2:]
-        return ret
-    else:
-        return data
-
-def decompress(in_data):
-    """Decompress the gzip txt file"""
-    with tempfile.TemporaryFile() as f:
-        f.write(in_data)
-        f.flush()
-        f.seek(0)
-        return gzip.open(f).read().decode('utf-8')
-
-def parse_msg(text):
-    """Parse an email message into summary text"""
-    logger.debug('parse_msg: %r',text)
+def decompress(chunks):
+    """
+    Decompress the gzip txt file as it streams in.
+
+    Args:
+        chunks (iterable): gzipped bytes, in pieces of any size
+
+    Returns:
+        generator: decompressed bytes
+    """
+    d = zlib.decompressobj(16+zlib.MAX_WBITS)
+    for chunk in chunks:
+        while chunk:
+            data = d.decompress(chunk)
+            if data:
+                yield data
+            chunk = b''
+            if d.eof:
+                # the start of another gzip member
+                chunk = d.unused_data
+                d = zlib.decompressobj(16+zlib.MAX_WBITS)
+    data = d.flush()
+    if data:
+        yield data
+
+def parse_msg(lines, legacy=False):
+    """
+    Parse an email message into summary text
+
+    Args:
+        lines (iterable): lines of the message, or the message as a str
+        legacy (bool): parse as the first version did, dropping folded
+                       header lines and decoding only the first encoded
+                       word, to match hashes recorded by it
+    """
+    if isinstance(lines, str):
+        lines = lines.split('\n')
     process_header = True
-    sender = None
-    date = None
-    subject = None
-    body = ''
-    for line in text.split('\n'):
-        line = line.strip()
+    headers = [] # [name, value], with folded lines joined
+    body = []
+    for line in lines:
         if process_header:
+            if line[:1] in (' ','\t') and line.strip():
+                # a continuation of the previous header
+                if headers and not legacy:
+                    headers[-1][1] += ' '+line.strip()
+                continue
+            line = line.strip()
             if not line:
                 process_header = False
-            elif line.startswith('From:'):
-                val = line.split(':',1)[1].strip().replace(' at ','@')
-                if '(' in val and ')' in val:
-                    val = val.split('(',1)[1].rsplit(')',1)[0].strip()
-                sender = decode_header(val)
-            elif line.startswith('Date:'):
-                val = line.split(':',1)[1].strip()
-                d = datetime.strptime(val, '%a, %d %b %Y %H:%M:%S %z')
-                val = (d - d.utcoffset()).replace(tzinfo=None).isoformat()
-                date = val+' UTC'
-            elif line.startswith('Subject:'):
-                val = line.split(':',1)[1].replace('[grid-logbook]','').strip()
-                subject = decode_header(val)
-        elif line.startswith('-------------- next part --------------'):
-            break # done processing
+            elif ':' in line:
+                headers.append(line.split(':',1))
         else:
-            body += line+'\n'
-    ret = ''
+            line = line.strip()
+            if line.startswith('-------------- next part --------------'):
+                break # done processing
+            body.append(line)
+    decode = legacy_decode_header if legacy else decode_header
+    sender = None
+    date = None
+    subject = None
+    for name,val in headers:
+        if name == 'From':
+            val = val.strip().replace(' at ','@')
+            if '(' in val and ')' in val:
+                val = val.split('(',1)[1].rsplit(')',1)[0].strip()
+            sender = decode(val)
+        elif name == 'Date':
+            d = datetime.strptime(val.strip(), '%a, %d %b %Y %H:%M:%S %z')
+            val = (d - d.utcoffset()).replace(tzinfo=None).isoformat()
+            date = val+' UTC'
+        elif name == 'Subject':
+            val = val.replace('[grid-logbook]','').strip()
+            subject = decode(val)
+    ret = []
     if sender:
-        ret += 'From: '+sender+'\n'
+        ret.append('From: '+sender+'\n')
     if date:
-        ret += 'Date: '+date+'\n'
+        ret.append('Date: '+date+'\n')
     if subject:
-        ret += 'Subject: '+subject+'\n'
+        ret.append('Subject: '+subject+'\n')
+    body = '\n'.join(body).strip()
     if body:
-        ret += '\n'+body.strip()
-    return ret
+        ret.append('\n'+body)
+    return ''.join(ret)
 
-def parse_month(text):
-    buffer = ''
-    ret = []
-    for line in text.split('\n'):
-        if re.match(r'From \w*.\w* at \w*.\w*.\w* *\w*',line) and buffer:
-            msg = parse_msg(buffer)
-            ret.append({'hash':hash(msg), 'text':msg})
-            buffer = ''
+# the "From " line that starts each message in an mbox archive
+mbox_separator = re.compile(r'From \w*.\w* at \w*.\w*.\w* *\w*')
+
+def iter_lines(chunks, encoding='utf-8'):
+    """
+    Split a stream of bytes into lines of text.
+
+    Args:
+        chunks (iterable): bytes, in pieces of any size
+        encoding (str): text encoding
+
+    Returns:
+        generator: lines, without the newline
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    tail = ''
+    for chunk in chunks:
+        lines = (tail+decoder.decode(chunk)).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line
+    tail += decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+def legacy_hash(lines):
+    """Hash of a message as the first parser saw it, or None"""
+    try:
+        return hash(parse_msg(lines, legacy=True))
+    except Exception:
+        return None # the first parser failed on it, so it was never sent
+
+def iter_messages(lines, legacy=False):
+    """
+    Split an mbox archive into messages, one at a time.
+
+    Args:
+        lines (iterable): lines of the archive
+        legacy (bool): also give the hash from the first parser
+
+    Returns:
+        generator: dicts of {hash, text}, and legacy_hash if asked
+    """
+    def message(buffer):
+        msg = parse_msg(buffer)
+        ret = {'hash':hash(msg), 'text':msg}
+        if legacy:
+            ret['legacy_hash'] = legacy_hash(buffer)
+        return ret
+    buffer = []
+    for line in lines:
+        if buffer and mbox_separator.match(line):
+            yield message(buffer)
+            buffer = []
         else:
-            buffer += line+'\n'
+            buffer.append(line)
     if buffer:
-        msg = parse_msg(buffer)
-        ret.append({'hash':hash(msg), 'text':msg})
-    logger.debug('month: %r',ret)
-    return ret
+        yield message(buffer)
+
+def parse_month(text):
+    return list(iter_messages(text.split('\n')))
+
+class SentIndex:
+    """
+    Hashes of the messages already sent, grouped by month.
+
+    Only the newest `months` months are kept, so the index stays
+    bounded while membership checks stay O(1).
+
+    Args:
+        filename (str): file to store the index in
+        months (int): number of months to keep
+    """
+    def __init__(self, filename='.sent_messages', months=3):
+        self.months = months
+        self.index = JSONStore(filename)
+
+    @staticmethod
+    def month_key(month):
+        try:
+            return datetime.strptime(month, '%Y-%B')
+        except ValueError:
+            return datetime.min
+
+    def __contains__(self, msg_hash):
+        return any(msg_hash in hashes for hashes in self.index.values())
+
+    def has_month(self, month):
+        return month in self.index
+
+    def add(self, month, msg_hash, save=True):
+        """Record a sent message, dropping the oldest months if needed"""
+        if month not in self.index:
+            self.index[month] = set()
+            for m in sorted(self.index, key=self.month_key)[:-self.months]:
+                if m != month:
+                    del self.index[m]
+        self.index[month].add(msg_hash)
+        if save:
+            self.save()
+
+    def save(self):
+        self.index.save()
+
+overlap_size = 1024 # bytes before the old end that are fetched again
+
+def fetch_month(url, state=None, request_args={}):
+    """
+    Fetch the new part of a month archive.
+
+    Archives only grow, so with the state of an earlier fetch only the
+    bytes past the old end are requested, and the validators let the
+    server answer 304 if nothing changed.  The request starts a little
+    before the old end, and if those bytes no longer match the digest
+    in the state the archive was rewritten, so all of it is fetched.
+
+    The body is streamed: the returned state gets its final offset
+    once the chunks have been read to the end.
+
+    Args:
+        url (str): url of the month archive
+        state (dict): state from the last fetch of this month, or None;
+                      ignored if it came from another url
+        request_args (dict): extra args for requests
+
+    Returns:
+        tuple: (iterator of new bytes or None, new state, text encoding)
+    """
+    # byte offsets only make sense without a content-encoding
+    headers = {'Accept-Encoding': 'identity'}
+    offset = 0
+    overlap = 0
+    if state and state.get('url') != url:
+        state = None # validators and offsets of another resource
+    if state:
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('modified'):
+            headers['If-Modified-Since'] = state['modified']
+        # without a digest of the tail, an offset cannot be trusted
+        if state.get('offset') and state.get('tail') and not url.endswith('.gz'):
+            offset = state['offset']
+            overlap = min(overlap_size, offset)
+            headers['Range'] = 'bytes=%d-'%(offset-overlap)
+    r = http_client.get(url, headers=headers, stream=True, **request_args)
+    if r.status_code == 304:
+        logger.info('month not modified')
+        r.close()
+        return None, state, None
+    if r.status_code == 416:
+        r.close()
+        logger.info('month archive shrank, fetching all of it')
+        return fetch_month(url, request_args=request_args)
+    try:
+        r.raise_for_status()
+    except Exception:
+        r.close()
+        raise
+    body = r.iter_content(chunk_size=65536)
+    tail = b''
+    if r.status_code == 206:
+        start = r.headers.get('Content-Range','').split(' ',1)[-1].split('-',1)[0]
+        if start != str(offset-overlap):
+            r.close()
+            logger.info('bad range response, fetching all of the month')
+            return fetch_month(url, request_args=request_args)
+        head = b''
+        for chunk in body:
+            head += chunk
+            if len(head) >= overlap:
+                break
+        if sha1(head[:overlap]).hexdigest() != state['tail']:
+            r.close()
+            logger.info('month archive was rewritten, fetching all of it')
+            return fetch_month(url, request_args=request_args)
+        tail = head[:overlap]
+        body = itertools.chain([head[overlap:]], body)
+    else:
+        offset = 0
+    new_state = {
+        'url': url,
+        'offset': offset,
+        'tail': sha1(tail).hexdigest(),
+        'etag': r.headers.get('ETag'),
+        'modified': r.headers.get('Last-Modified'),
+    }
+    def chunks():
+        last = tail
+        with r:
+            for chunk in body:
+                if not chunk:
+                    continue
+                last = (last+chunk)[-overlap_size:]
+                new_state['offset'] += len(chunk)
+                new_state['tail'] = sha1(last).hexdigest()
+                yield chunk
+        logger.info('fetched %d bytes', new_state['offset']-offset)
+        http_client.response_bytes.inc(new_state['offset']-offset,
+                                       host=urlparse(url).netloc)
+    return chunks(), new_state, r.encoding or 'utf-8'
 
 def monitor(archives, send=lambda a:None, delay=60*5, failure_thresh=5,
             user=None, password=None):
@@ -133,71 +336,122 @@ def monitor(archives, send=lambda a:None, delay=60*5, failure_thresh=5,
         password (str): password for http basic auth
     """
     main_failures = 0
-    last_message = load('.last_message')
+    last_message = JSONStore('.last_message')
     if not last_message:
-        last_message = {'hash':None, 'link':None}
+        last_message.update({'hash':None, 'link':None})
+    if 'fetch' not in last_message:
+        last_message['fetch'] = None # incremental state of the month
+    sent = SentIndex()
     request_args = {}
     if user and password:
         request_args['auth'] = (user,password)
+
+    def send_msg(msg, month):
+        logger.info('sending new message:\n%r',msg['text'])
+        send('```'+msg['text']+'```')
+        messages_sent.inc()
+        sent.add(month, msg['hash'])
+        if last_message['link'] != month:
+            last_message['fetch'] = None
+        last_message['hash'] = msg['hash']
+        last_message['link'] = month
+        last_message.save()
+
     while True:
-        try:
-            r = requests.get(archives, timeout=10, **request_args)
-            r.raise_for_status()
-        except Exception:
-            logger.warn('error getting main page', exc_info=True)
-            main_failures += 1
-            if main_failures > failure_thresh:
-                send('mailinglist server is down')
-        else:
-            main_failures = 0
-            month_links = []
+        with profiling.cycle('grid_logbook'):
             try:
-                root = objectify.fromstring(r.content, parser=html.HTMLParser())
-                for e in root.body.cssselect('table td a'):
-                    link = e.get('href')
-                    if link.endswith('.txt.gz'):
-                        link = link[:-3]
-                    if link.endswith('.txt'):
-                        month_links.append(link)
-                        if link.split('.',1)[0] == last_message['link']:
-                            break # stop once we've reached the recorded month
-
-                # sort by recorded month first
-                month_links.reverse()
-                logger.info('months: %r',month_links)
-                for link in month_links:
-                    logger.info('anaylzing %s',link)
-                    try:
-                        r = requests.get(os.path.join(archives, link), timeout=10,
-                                         **request_args)
-                        r.raise_for_status()
-                    except Exception:
-                        logger.warn('error getting month page')
-                        raise
-                    else:
+                r = http_client.get(archives, **request_args)
+                r.raise_for_status()
+            except Exception:
+                logger.warn('error getting main page', exc_info=True)
+                main_failures += 1
+                if main_failures > failure_thresh:
+                    send('mailinglist server is down')
+            else:
+                main_failures = 0
+                month_links = []
+                try:
+                    root = objectify.fromstring(r.content, parser=html.HTMLParser())
+                    for e in root.body.cssselect('table td a'):
+                        link = e.get('href')
+                        if link.endswith('.txt.gz') and (not month_links or
+                                link.split('.',1)[0] == last_message['link']):
+                            # the newest and the recorded month may still
+                            # have messages the nightly .gz lacks, so fetch
+                            # them as text. older months come gzipped.
+                            link = link[:-3]
+                        if link.endswith('.txt') or link.endswith('.txt.gz'):
+                            month_links.append(link)
+                            if link.split('.',1)[0] == last_message['link']:
+                                break # stop once we've reached the recorded month
+
+                    # sort by recorded month first
+                    month_links.reverse()
+                    logger.info('months: %r',month_links)
+                    for link in month_links:
+                        logger.info('anaylzing %s',link)
+                        month = link.split('.',1)[0]
+                        state = None
+                        if month == last_message['link']:
+                            state = last_message['fetch']
+                        try:
+                            data, state, encoding = fetch_month(
+                                    os.path.join(archives, link),
+                                    state, request_args)
+                        except Exception:
+                            logger.warn('error getting month page')
+                            raise
+                        if data is None:
+                            continue
                         if link.endswith('.gz'):
-                            data = decompress(r.content)
+                            lines = iter_lines(decompress(data))
                         else:
-                            data = r.text
+                            lines = iter_lines(data, encoding)
+                        # a month from before the sent index existed is
+                        # filtered by the last sent message instead
+                        seeding = (not sent.has_month(month) and
+                                   month == last_message['link'])
                         out_buffer = []
-                        last_hash = None
-                        # filter the messages to remove previously sent ones
-                        for msg in parse_month(data):
-                            if msg['hash'] == last_message['hash']:
-                                out_buffer = []
+                        found = False
+                        new_messages = 0
+                        start = time.time()
+                        for msg in iter_messages(lines, legacy=seeding):
+                            if msg['hash'] in sent:
                                 continue
-                            out_buffer.append(msg)
-                        # send the messages
-                        if not out_buffer:
-                            logger.info('no new messages')
-                            continue
+                            if seeding:
+                                # the last hash may be from the first parser
+                                if last_message['hash'] in (msg['hash'],
+                                                            msg['legacy_hash']):
+                                    for m in out_buffer+[msg]:
+                                        sent.add(month, m['hash'], save=False)
+                                    sent.save()
+                                    out_buffer = []
+                                    found = True
+                                else:
+                                    out_buffer.append(msg)
+                                continue
+                            new_messages += 1
+                            send_msg(msg, month)
+                        if seeding and not found and out_buffer:
+                            # do not repost a whole month we cannot place
+                            logger.warn('last sent message not found in %s, '
+                                        'marking its %d messages as sent',
+                                        month, len(out_buffer))
+                            for msg in out_buffer:
+                                sent.add(month, msg['hash'], save=False)
+                            sent.save()
+                            out_buffer = []
                         for msg in out_buffer:
-                            logger.info('sending new message:\n%r',msg['text'])
-                            send('```'+msg['text']+'```')
-                            last_message = {'hash':msg['hash'],'link':link.split('.',1)[0]}
-                            store(last_message, '.last_message')
-            except Exception:
-                logger.warn('parsing error', exc_info=True)
-                continue
+                            new_messages += 1
+                            send_msg(msg, month)
+                        month_seconds.observe(time.time()-start)
+                        if not new_messages:
+                            logger.info('no new messages')
+                        if last_message['link'] == month:
+                            last_message['fetch'] = state
+                            last_message.save()
+                except Exception:
+                    logger.warn('parsing error', exc_info=True)
+                    continue
 
         time.sleep(delay)
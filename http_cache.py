@@ -0,0 +1,86 @@
+"""
+Poll web pages with conditional requests.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import threading
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+import http_client
+
+import logging
+
+logger = logging.getLogger('http_cache')
+
+
+class PageCache:
+    """
+    Remember the validators for each polled url.
+
+    Requests send If-None-Match / If-Modified-Since when the server
+    gave an ETag / Last-Modified, so an unchanged page costs a 304.
+    Only a 304 skips the body: other responses are streamed to the
+    caller as they arrive, so an identical body cannot be told apart
+    before it has been parsed.  The validators are recorded once the
+    body has been read to the end.
+    """
+    def __init__(self):
+        self.pages = {} # url: {'etag', 'last_modified'}
+        self.lock = threading.Lock()
+
+    def fetch(self, url, chunk_size=65536, **kwargs):
+        """
+        Get a page unless the server says it is not modified.
+
+        Args:
+            url (str): address of the page
+            chunk_size (int): bytes per chunk of the body
+            **kwargs: passed to `http_client.get`
+
+        Returns:
+            iterator: the page as chunks of bytes, or None on a 304
+
+        Raises:
+            requests.exceptions.RequestException: on a failed request
+        """
+        with self.lock:
+            page = dict(self.pages.get(url, {}))
+        headers = dict(kwargs.pop('headers', None) or {})
+        if page.get('etag'):
+            headers['If-None-Match'] = page['etag']
+        if page.get('last_modified'):
+            headers['If-Modified-Since'] = page['last_modified']
+        r = http_client.get(url, headers=headers, stream=True, **kwargs)
+        if r.status_code == 304 and page:
+            logger.debug('%s not modified', url)
+            r.close()
+            return None
+        try:
+            r.raise_for_status()
+        except Exception:
+            r.close()
+            raise
+        return self._read(url, r, chunk_size)
+
+    def _read(self, url, r, chunk_size):
+        """Pass the body through, then record its validators"""
+        size = 0
+        with r:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                size += len(chunk)
+                yield chunk
+        http_client.response_bytes.inc(size, host=urlparse(url).netloc)
+        with self.lock:
+            self.pages[url] = {
+                'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified'),
+            }
+
+    def forget(self, url):
+        """Drop what is known about a url, so the next fetch is full"""
+        with self.lock:
+            self.pages.pop(url, None)
@@ -0,0 +1,116 @@
+"""
+A shared HTTP client, so polls reuse warm keep-alive connections.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import threading
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+import logging
+
+logger = logging.getLogger('http_client')
+
+request_seconds = metrics.histogram('http_request_seconds',
+        'time until the response headers arrive, including retries')
+responses = metrics.counter('http_responses_total', 'responses by status code')
+errors = metrics.counter('http_errors_total', 'requests that got no response')
+response_bytes = metrics.counter('http_response_bytes_total', 'body bytes read')
+
+
+class Session(requests.Session):
+    """
+    A requests session with connection pools, retries, and a timeout.
+
+    Failed connections and 502/503/504 responses are retried with
+    exponential backoff.  Only idempotent methods are retried after
+    the request was sent.  Requests that do not give a timeout get
+    the session default.
+
+    Args:
+        timeout (float): default request timeout in seconds
+        retries (int): max retries per request
+        backoff (float): backoff factor between retries, in seconds
+        pool_connections (int): number of hosts to keep pools for
+        pool_maxsize (int): max idle connections kept per host
+    """
+    def __init__(self, timeout=10, retries=3, backoff=0.5,
+                 pool_connections=16, pool_maxsize=8):
+        super(Session, self).__init__()
+        self.timeout = timeout
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=(502,503,504),
+                      allowed_methods=frozenset(['GET','HEAD','OPTIONS']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize, max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        host = urlparse(url).netloc
+        start = time.time()
+        try:
+            r = super(Session, self).request(method, url, **kwargs)
+        except Exception:
+            errors.inc(host=host)
+            raise
+        finally:
+            request_seconds.observe(time.time()-start, host=host)
+        responses.inc(host=host, code=r.status_code)
+        if not kwargs.get('stream'):
+            # streamed bodies are counted by whoever reads them
+            response_bytes.inc(len(r.content), host=host)
+        return r
+
+_session = None
+_settings = {}
+_lock = threading.Lock()
+
+def configure(**kwargs):
+    """
+    Set the options of the shared session (see `Session`).
+
+    Meant to be called at startup.  Requests already in flight finish
+    on the old session.
+    """
+    global _session
+    with _lock:
+        _settings.clear()
+        _settings.update(kwargs)
+        _session = None
+
+def new_session():
+    """
+    Make a session of its own, with the options of the shared one.
+
+    For callers that keep per-session state, like login cookies.
+    """
+    with _lock:
+        settings = dict(_settings)
+    return Session(**settings)
+
+def session():
+    """Get the shared session"""
+    global _session
+    with _lock:
+        if not _session:
+            logger.debug('new shared session: %r', _settings)
+            _session = Session(**_settings)
+        return _session
+
+def get(url, **kwargs):
+    """GET a url with the shared session. Args are as `requests.get`."""
+    return session().get(url, **kwargs)
@@ -6,6 +6,8 @@ from __future__ import absolute_import, division, print_function
 
 import os
 import json
+import threading
+from hashlib import sha1
 from datetime import date,datetime,time
 
 import logging
@@ -19,6 +21,13 @@ class datetime_converter:
         return obj.isoformat()
     @staticmethod
     def loads(obj,name=None):
+        try:
+            return datetime.fromisoformat(obj)
+        except (AttributeError, ValueError):
+            # older python, or a bare time
+            return datetime_converter.parse(obj)
+    @staticmethod
+    def parse(obj):
         if ':' in obj:
             if 'T' in obj or ' ' in obj:
                 center = ' '
@@ -42,14 +51,20 @@ class datetime_converter:
 class date_converter(datetime_converter):
     @staticmethod
     def loads(obj,name=None):
-        d = datetime_converter.loads(obj)
-        return date(d.year,d.month,d.day)
+        try:
+            return date.fromisoformat(obj)
+        except (AttributeError, ValueError):
+            d = datetime_converter.parse(obj)
+            return date(d.year,d.month,d.day)
 
 class time_converter(datetime_converter):
     @staticmethod
     def loads(obj,name=None):
-        d = datetime_converter.loads(obj)
-        return time(d.hour,d.minute,d.second,d.microsecond)
+        try:
+            return time.fromisoformat(obj)
+        except (AttributeError, ValueError):
+            d = datetime_converter.parse(obj)
+            return time(d.hour,d.minute,d.second,d.microsecond)
 
 class set_converter:
     @staticmethod
@@ -77,18 +92,19 @@ def objToJSON(obj):
             raise Exception('Cannot encode %s class to JSON'%name)
 
 def JSONToObj(obj):
-    ret = obj
-    if isinstance(obj,dict) and '__jsonclass__' in obj:
-        logging.info('try unpacking class')
-        try:
-            name = obj['__jsonclass__'][0]
-            if name not in JSONConverters:
-                raise Exception('class %r not found in converters'%name)
-            obj_repr = obj['__jsonclass__'][1]
-            ret = JSONConverters[name].loads(obj_repr,name=name)
-        except Exception as e:
-            logging.warn('error making json class: %r',e,exc_info=True)
-    return ret
+    # called for every json object, so keep the common case cheap
+    tag = obj.get('__jsonclass__')
+    if tag is None:
+        return obj
+    try:
+        name, obj_repr = tag
+        converter = JSONConverters.get(name)
+        if converter is None:
+            raise Exception('class %r not found in converters'%name)
+        return converter.loads(obj_repr,name=name)
+    except Exception as e:
+        logging.warn('error making json class: %r',e,exc_info=True)
+    return obj
 
 # copied from tornado.escape so we don't have to include that project
 def recursive_unicode(obj):
@@ -109,6 +125,22 @@ def recursive_unicode(obj):
     else:
         return obj
 
+def _replay(data, filename):
+    """Apply the changes in a journal file to `data`"""
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                change = json.loads(line, object_hook=JSONToObj)
+            except ValueError:
+                # a partial write at the end of the journal
+                logger.info('bad journal line in %s', filename)
+                break
+            data.update(change.get('set', {}))
+            for k in change.get('del', []):
+                data.pop(k, None)
+
 def load(filename):
     try:
         with open(filename, 'r') as f:
@@ -117,17 +149,193 @@ def load(filename):
         sites = {}
     if not isinstance(sites,dict):
         sites = {}
+    try:
+        _replay(sites, filename+'.journal.old')
+        _replay(sites, filename+'.journal')
+    except:
+        logger.info('cannot replay journal', exc_info=True)
     return sites
 
-def store(data, filename):
+_encoder = json.JSONEncoder(default=objToJSON, separators=(',',':'),
+                            sort_keys=True)
+
+def write_file(filename, text):
+    """
+    Atomically replace a file, durably.
+
+    The data is written to a temp file and synced, then renamed over
+    the target, and the directory is synced so the rename survives a
+    crash.
+    """
+    tmp = filename+'_'
+    try:
+        with open(tmp,'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, filename)
+        dirfd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def encode(obj):
+    return _encoder.encode(recursive_unicode(obj))
+
+class Journal:
+    """
+    Append-only journal for a dict stored in a json file.
+
+    Each store appends just the keys that changed since the last
+    store.  Callers that know which keys they changed can pass them,
+    so only those values are encoded.  Once the journal grows past `compact_size` bytes, it is
+    folded back into the main file by a background thread.
+
+    Args:
+        filename (str): main json file
+        compact_size (int): journal size that triggers compaction
+    """
+    def __init__(self, filename, compact_size=1<<20):
+        self.filename = filename
+        self.compact_size = compact_size
+        self.lock = threading.Lock()
+        self.encoded = None # {key: json of value} as of the last store
+        self.size = 0
+        self.compacting = False
+
+    def store(self, data, changed=None, deleted=None):
+        """
+        Store the changes to `data` since the last store.
+
+        Args:
+            data (dict): data to store
+            changed (iterable): keys that were set since the last store,
+                                or None to compare every key
+            deleted (iterable): keys that were removed since the last store
+        """
+        with self.lock:
+            if self.encoded is None:
+                # no known baseline, so start over from a snapshot
+                encoded = {k:encode(data[k]) for k in data}
+                self._write_snapshot(encoded)
+                for suffix in ('.journal','.journal.old'):
+                    if os.path.exists(self.filename+suffix):
+                        os.remove(self.filename+suffix)
+                self.encoded = encoded
+                self.size = 0
+                return
+            if changed is None and deleted is None:
+                encoded = {k:encode(data[k]) for k in data}
+                changed = {k:v for k,v in encoded.items()
+                           if self.encoded.get(k) != v}
+                deleted = [k for k in self.encoded if k not in encoded]
+            else:
+                # only encode the keys the caller says changed
+                deleted = set(deleted or ())
+                deleted.update(k for k in (changed or ()) if k not in data)
+                changed = {k:encode(data[k]) for k in (changed or ())
+                           if k in data}
+                changed = {k:v for k,v in changed.items()
+                           if self.encoded.get(k) != v}
+                deleted = [k for k in deleted if k in self.encoded]
+            if not changed and not deleted:
+                return
+            line = ['{"set":{']
+            line.append(','.join(json.dumps(k)+':'+changed[k] for k in changed))
+            line.append('},"del":'+json.dumps(deleted)+'}\n')
+            line = ''.join(line)
+            with open(self.filename+'.journal', 'a') as f:
+                f.write(line)
+            self.size += len(line)
+            self.encoded.update(changed)
+            for k in deleted:
+                del self.encoded[k]
+            if self.size > self.compact_size and not self.compacting:
+                # new changes go to a fresh journal while compacting
+                os.rename(self.filename+'.journal',
+                          self.filename+'.journal.old')
+                self.size = 0
+                self.compacting = True
+                t = threading.Thread(target=self._compact,
+                                     args=(dict(self.encoded),))
+                t.daemon = True
+                t.start()
+
+    def _write_snapshot(self, encoded):
+        write_file(self.filename, '{'+','.join(json.dumps(k)+':'+encoded[k]
+                                               for k in encoded)+'}')
+
+    def _compact(self, encoded):
+        with self.lock:
+            try:
+                self._write_snapshot(encoded)
+                os.remove(self.filename+'.journal.old')
+            except:
+                logger.info('cannot compact', exc_info=True)
+                self.encoded = None # write a full snapshot next time
+            finally:
+                self.compacting = False
+
+_journals = {}
+_journals_lock = threading.Lock()
+_digests = {} # filename: digest of the last write
+
+def store(data, filename, journal=False, changed=None, deleted=None):
+    """
+    Store a dict to a json file.
+
+    Args:
+        data (dict): data to store
+        filename (str): file to store to
+        journal (bool): only append the changed keys to a journal,
+                        instead of rewriting the whole file
+        changed (iterable): with a journal, the keys set since the last
+                            store (default: compare all keys)
+        deleted (iterable): with a journal, the keys removed since the
+                            last store
+    """
+    if journal and isinstance(data, dict):
+        with _journals_lock:
+            if filename not in _journals:
+                _journals[filename] = Journal(filename)
+            j = _journals[filename]
+        try:
+            j.store(data, changed=changed, deleted=deleted)
+        except:
+            logger.info('cannot save', exc_info=True)
+            j.encoded = None # start from a snapshot next time
+        return
     try:
-        with open(filename+'_','w') as f:
-            json.dump(recursive_unicode(data), f, default=objToJSON,
-                      separators=(',',':'))
-        os.rename(filename+'_',filename)
+        # dumps uses the C encoder, dump does not
+        text = json.dumps(recursive_unicode(data), default=objToJSON,
+                          separators=(',',':'))
+        digest = sha1(text.encode('utf-8')).digest()
+        if _digests.get(filename) == digest and os.path.exists(filename):
+            return # unchanged since the last write
+        write_file(filename, text)
+        _digests[filename] = digest
     except:
         logger.info('cannot save', exc_info=True)
-    finally:
-        if os.path.exists(filename+'_'):
-            os.remove(filename+'_')
 
+class JSONStore(dict):
+    """
+    A dict backed by a json file.
+
+    `save()` writes the file only if the contents changed since the
+    last save, using the same atomic rename as `store()`.
+
+    Args:
+        filename (str): file to load from and save to
+        journal (bool): save through the journal (see `store()`)
+    """
+    def __init__(self, filename, journal=False):
+        super(JSONStore, self).__init__(load(filename))
+        self.filename = filename
+        self.journal = journal
+
+    def save(self):
+        store(self, self.filename, journal=self.journal)
@@ -0,0 +1,195 @@
+"""
+Counters, gauges and histograms, exported in the Prometheus text format.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import logging
+
+logger = logging.getLogger('metrics')
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key)+list(extra)
+    if not pairs:
+        return ''
+    return '{'+','.join('%s="%s"'%(k, str(v).replace('\\','\\\\')
+                                         .replace('"','\\"')
+                                         .replace('\n','\\n'))
+                        for k,v in pairs)+'}'
+
+class Metric:
+    """Base class: a named metric with one value per set of labels"""
+    type = None
+
+    def __init__(self, name, doc=''):
+        self.name = name
+        self.doc = doc
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = ['# HELP %s %s'%(self.name, self.doc),
+                 '# TYPE %s %s'%(self.name, self.type)]
+        with self.lock:
+            for key in sorted(self.values):
+                lines.extend(self._render_value(key, self.values[key]))
+        return lines
+
+    def _render_value(self, key, value):
+        return ['%s%s %r'%(self.name, _format_labels(key), value)]
+
+class Counter(Metric):
+    """A count that only goes up"""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0)+amount
+
+class Gauge(Metric):
+    """A value that is set to the current reading"""
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0)+amount
+
+class Histogram(Metric):
+    """
+    Observations counted into buckets, plus their sum and count.
+
+    Args:
+        name (str): metric name
+        doc (str): help text
+        buckets (list): upper bounds of the buckets, ascending
+    """
+    type = 'histogram'
+    default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, doc='', buckets=default_buckets):
+        Metric.__init__(self, name, doc)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.values:
+                # per-bucket counts, then sum and count
+                self.values[key] = [0]*(len(self.buckets)+1)+[0.0, 0]
+            v = self.values[key]
+            v[i] += 1
+            v[-2] += value
+            v[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a block, in seconds"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time()-start, **labels)
+
+    def _render_value(self, key, value):
+        lines = []
+        total = 0
+        for bound,count in zip(self.buckets+('+Inf',), value):
+            total += count
+            lines.append('%s_bucket%s %d'%(self.name,
+                         _format_labels(key, [('le',bound)]), total))
+        lines.append('%s_sum%s %r'%(self.name, _format_labels(key), value[-2]))
+        lines.append('%s_count%s %d'%(self.name, _format_labels(key), value[-1]))
+        return lines
+
+
+_metrics = {}
+_lock = threading.Lock()
+
+def _get(cls, name, doc, **kwargs):
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = cls(name, doc, **kwargs)
+        elif not isinstance(_metrics[name], cls):
+            raise Exception('metric %s is a %s'%(name, _metrics[name].type))
+        return _metrics[name]
+
+def counter(name, doc=''):
+    """Get or make the named counter"""
+    return _get(Counter, name, doc)
+
+def gauge(name, doc=''):
+    """Get or make the named gauge"""
+    return _get(Gauge, name, doc)
+
+def histogram(name, doc='', **kwargs):
+    """Get or make the named histogram"""
+    return _get(Histogram, name, doc, **kwargs)
+
+def render():
+    """Get all metrics in the Prometheus text format"""
+    with _lock:
+        metrics = [_metrics[k] for k in sorted(_metrics)]
+    lines = []
+    for m in metrics:
+        lines.extend(m.render())
+    return '\n'.join(lines)+'\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?',1)[0] not in ('/','/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve(port, address='127.0.0.1'):
+    """
+    Serve the metrics over http from a background thread.
+
+    Args:
+        port (int): port to listen on
+        address (str): address to listen on
+
+    Returns:
+        the http server
+    """
+    server = _Server((address, port), _Handler)
+    t = threading.Thread(target=server.serve_forever, name='metrics')
+    t.daemon = True
+    t.start()
+    logger.info('serving metrics on %s:%d', address, server.server_port)
+    return server
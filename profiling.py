@@ -0,0 +1,130 @@
+"""
+Profile monitor cycles and slack dispatches in a running bot.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import glob
+import time
+import atexit
+import pstats
+import cProfile
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+import logging
+
+logger = logging.getLogger('profiling')
+
+_settings = None
+_lock = threading.Lock()
+_stats = {} # name: [pstats.Stats or None, start of the window]
+_local = threading.local() # is this thread already profiling
+
+def enable(directory='profiles', interval=3600, keep=24, timing_size=1<<20):
+    """
+    Turn on profiling for `cycle()`.
+
+    For each cycle name, the directory gets a `name.timing` file with
+    one line per cycle (the time it ended and how many seconds it took),
+    and a `name-YYYYmmddTHHMMSS.prof` pstats dump every `interval`
+    seconds aggregating the cycles since the last dump.
+
+    Args:
+        directory (str): where to write timings and dumps
+        interval (float): seconds of cycles to aggregate per dump
+        keep (int): number of dumps to keep per name
+        timing_size (int): rotate a timing file past this many bytes
+    """
+    global _settings
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with _lock:
+        first = _settings is None
+        _settings = {'directory':directory, 'interval':interval,
+                     'keep':keep, 'timing_size':timing_size}
+    if first:
+        atexit.register(dump)
+    logger.info('profiling to %s', directory)
+
+@contextmanager
+def cycle(name):
+    """
+    Profile a block as one cycle of `name`.
+
+    Does nothing unless profiling is enabled.  If another profiler is
+    already active (a nested cycle, or one in another thread on Pythons
+    that allow only one), the cycle is only timed.
+    """
+    if _settings is None:
+        yield
+        return
+    prof = None
+    if not getattr(_local, 'active', False):
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            prof = None
+        else:
+            _local.active = True
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        if prof:
+            prof.disable()
+            _local.active = False
+        try:
+            _record(name, prof, start, end)
+        except Exception:
+            logger.warn('cannot record profile for %s', name, exc_info=True)
+
+def _record(name, prof, start, end):
+    settings = _settings
+    timing = os.path.join(settings['directory'], name+'.timing')
+    with _lock:
+        if (os.path.exists(timing) and
+            os.path.getsize(timing) > settings['timing_size']):
+            os.rename(timing, timing+'.1')
+        with open(timing, 'a') as f:
+            f.write('%s %.6f\n'%(datetime.utcfromtimestamp(end).isoformat(),
+                                 end-start))
+        if name not in _stats:
+            _stats[name] = [None, start]
+        entry = _stats[name]
+        if prof:
+            if entry[0] is None:
+                entry[0] = pstats.Stats(prof)
+            else:
+                entry[0].add(prof)
+        if end-entry[1] >= settings['interval']:
+            _dump(name)
+
+def _dump(name):
+    """Write and rotate the aggregated stats of a name.  Holds `_lock`."""
+    stats, start = _stats.pop(name)
+    if stats is None:
+        return
+    directory = _settings['directory']
+    filename = os.path.join(directory, '%s-%s.prof'%(name,
+               datetime.utcnow().strftime('%Y%m%dT%H%M%S')))
+    stats.dump_stats(filename+'_')
+    os.rename(filename+'_', filename)
+    old = sorted(glob.glob(os.path.join(directory, name+'-*.prof')))
+    for f in old[:-_settings['keep']]:
+        os.remove(f)
+
+def dump():
+    """Write the stats aggregated so far for every name"""
+    if _settings is None:
+        return
+    with _lock:
+        for name in list(_stats):
+            try:
+                _dump(name)
+            except Exception:
+                logger.warn('cannot dump profile for %s', name, exc_info=True)
@@ -3,17 +3,311 @@ Communicate with slack as an RTM bot
 """
 
 import os
+import json
 import time
 import logging
 import random
 import re
+import select
+import itertools
+import threading
+from collections import deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from datetime import datetime, timedelta
+from concurrent.futures import Future
 from contextlib import contextmanager
 from pprint import pprint
 
 import requests
 from slackclient import SlackClient
 
+from json_store import JSONStore, store, write_file
+import metrics
+import profiling
+
+queue_depth = metrics.gauge('slack_queue_depth', 'messages waiting to be posted')
+pending_acks = metrics.gauge('slack_pending_acks', 'posts waiting for an ack')
+ack_seconds = metrics.histogram('slack_ack_seconds', 'time from a post to its ack')
+posts_sent = metrics.counter('slack_posts_total', 'posts written to the websocket')
+retries = metrics.counter('slack_retries_total', 'posts sent again')
+dropped = metrics.counter('slack_dropped_total', 'posts given up on')
+
+
+def user_display_name(user):
+    """Get the name to show for a slack user object"""
+    return user.get('real_name') or user['name']
+
+class UserCache:
+    """
+    Slack user names, persisted to disk.
+
+    The file is only read on first use.  Entries older than `ttl`
+    are still returned, but should be refreshed.  Updates are written
+    back from a timer thread, at most once every `save_delay` seconds.
+
+    Args:
+        filename (str): file to store the cache in
+        ttl (float): seconds before an entry is stale
+        save_delay (float): seconds to gather updates before a write
+    """
+    def __init__(self, filename='.slack_users', ttl=7*24*3600, save_delay=10.0):
+        self.filename = filename
+        self.ttl = timedelta(seconds=ttl)
+        self.save_delay = save_delay
+        self.users = None
+        self.lock = threading.Lock()
+        self._timer = None
+        self._save_lock = threading.Lock()
+
+    def _load(self):
+        if self.users is None:
+            self.users = JSONStore(self.filename)
+
+    def get(self, user_id):
+        """
+        Get a user name.
+
+        Returns:
+            tuple: (name or None, is stale)
+        """
+        with self.lock:
+            self._load()
+            if user_id not in self.users:
+                return None, True
+            entry = self.users[user_id]
+            return entry['name'], entry['time'] < datetime.utcnow()-self.ttl
+
+    def update(self, user_id, name, known_only=False):
+        """
+        Set a user name.
+
+        Args:
+            user_id (str): slack user id
+            name (str): display name
+            known_only (bool): ignore users not already in the cache
+        """
+        with self.lock:
+            self._load()
+            if known_only and user_id not in self.users:
+                return
+            self.users[user_id] = {'name':name, 'time':datetime.utcnow()}
+            if not self._timer:
+                self._timer = threading.Timer(self.save_delay, self.save)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def save(self):
+        """Write the cache, outside the lock so lookups are not held up"""
+        with self.lock:
+            self._timer = None
+            if self.users is None:
+                return
+            users = dict(self.users) # entries are replaced, not changed
+        with self._save_lock:
+            store(users, self.filename)
+
+class TokenBucket:
+    """
+    Allow `rate` events per second on average, in bursts of up to `burst`.
+    """
+    def __init__(self, rate=1.0, burst=3):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens+(now-self.last)*self.rate)
+        self.last = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1-self.tokens)/self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+def split_message(msg, max_length):
+    """Split a message into pieces of at most `max_length`, at newlines if possible"""
+    parts = []
+    while len(msg) > max_length:
+        pos = msg.rfind('\n', 0, max_length+1)
+        if pos > 0:
+            parts.append(msg[:pos])
+            msg = msg[pos+1:]
+        else:
+            parts.append(msg[:max_length])
+            msg = msg[max_length:]
+    parts.append(msg)
+    return parts
+
+class ChannelOutbox:
+    """
+    Messages waiting to be posted to one channel.
+
+    Each entry is (msg, attempt, not_before, spool ids).  Posts are rate limited
+    by a token bucket, and consecutive entries are joined into one
+    post up to `max_length`.
+    """
+    def __init__(self, rate, burst):
+        self.entries = deque()
+        self.bucket = TokenBucket(rate, burst)
+
+    def ready_in(self, now):
+        """Seconds until the next post can go out, or None if empty"""
+        if not self.entries:
+            return None
+        return max(self.entries[0][2]-now, self.bucket.wait_time(now), 0)
+
+    def take(self, now, max_length):
+        """
+        Take the next post, merging as many entries as fit.
+
+        Entries waiting out a retry backoff are not merged early.
+
+        Returns:
+            tuple: (text, attempt, spool ids)
+        """
+        texts = []
+        size = 0
+        attempt = 0
+        ids = ()
+        while self.entries:
+            msg, a, not_before, entry_ids = self.entries[0]
+            if texts and ((a and not_before > now) or
+                          size+1+len(msg) > max_length):
+                break
+            texts.append(msg)
+            size += len(msg)+(1 if size else 0)
+            attempt = max(attempt, a)
+            ids += entry_ids
+            self.entries.popleft()
+        self.bucket.take(now)
+        return '\n'.join(texts), attempt, ids
+
+class Spool:
+    """
+    A durable append-only log of outbound messages.
+
+    Each line is a json record, `{"id", "channel", "msg"}` when a
+    message is queued and `{"done"}` once it is finished with.  Writes
+    are group committed: the first writer to find no write in progress
+    becomes the leader and writes everything buffered so far with one
+    fsync, while the others wait for it.  Done records are not synced,
+    since losing one only means sending a message twice.
+
+    Args:
+        filename (str): spool file
+        compact_size (int): truncate the file past this size once
+                            nothing is outstanding
+    """
+    def __init__(self, filename='.slack_spool', compact_size=1<<20):
+        self.filename = filename
+        self.compact_size = compact_size
+        self.cond = threading.Condition()
+        self.outstanding = {} # id: (channel, msg)
+        self.ids = itertools.count(1)
+        self.buffer = [] # lines not written yet
+        self.appended = 0 # lines ever buffered
+        self.durable = 0 # lines ever written
+        self.sync = False # buffer holds records that need an fsync
+        self.writing = False
+        self.f = None
+
+    def replay(self):
+        """
+        Open the spool, rewriting it with only the unfinished messages.
+
+        Returns:
+            list: (id, channel, msg) of unfinished messages, in order
+        """
+        pending = {}
+        last_id = 0
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue # torn write at the end
+                    if 'done' in rec:
+                        pending.pop(rec['done'], None)
+                    else:
+                        pending[rec['id']] = (rec['channel'], rec['msg'])
+                        last_id = max(last_id, rec['id'])
+        ret = sorted((k,)+v for k,v in pending.items())
+        with self.cond:
+            write_file(self.filename, ''.join(json.dumps({'id':k,
+                       'channel':c, 'msg':m})+'\n' for k,c,m in ret))
+            self.f = open(self.filename, 'a')
+            self.outstanding = pending
+            self.ids = itertools.count(last_id+1)
+        return ret
+
+    def add(self, channel, msg):
+        """
+        Durably record a message before it is sent.
+
+        Returns:
+            int: spool id of the message
+        """
+        with self.cond:
+            spool_id = next(self.ids)
+            self.outstanding[spool_id] = (channel, msg)
+            self.buffer.append(json.dumps({'id':spool_id, 'channel':channel,
+                                           'msg':msg})+'\n')
+            self.appended += 1
+            self.sync = True
+            mine = self.appended
+            while self.durable < mine:
+                if self.writing:
+                    self.cond.wait()
+                else:
+                    self._write()
+        return spool_id
+
+    def done(self, spool_id):
+        """Record that a message needs no more sending"""
+        with self.cond:
+            if self.outstanding.pop(spool_id, None) is None:
+                return
+            self.buffer.append(json.dumps({'done':spool_id})+'\n')
+            self.appended += 1
+            if not self.writing:
+                self._write()
+
+    def _write(self):
+        """Write the buffer as leader, until it is empty.  Holds `cond`."""
+        self.writing = True
+        try:
+            while self.buffer:
+                batch, self.buffer = self.buffer, []
+                end, sync, self.sync = self.appended, self.sync, False
+                self.cond.release()
+                try:
+                    self.f.write(''.join(batch))
+                    self.f.flush()
+                    if sync:
+                        os.fsync(self.f.fileno())
+                except Exception:
+                    logging.warn('cannot write slack spool', exc_info=True)
+                finally:
+                    self.cond.acquire()
+                self.durable = end
+                self.cond.notify_all()
+            if (not self.outstanding and
+                self.f.tell() > self.compact_size):
+                self.f.close()
+                write_file(self.filename, '')
+                self.f = open(self.filename, 'a')
+        finally:
+            self.writing = False
+            self.cond.notify_all()
 
 def parse_slack_message(txt):
     """Remove added bits from slack message text, like url links"""
@@ -21,33 +315,69 @@ def parse_slack_message(txt):
 
 class SlackMessage:
     def __init__(self, token, handler=None, filter_me=True, delay=1.0,
-                 pingtime=10.0, testing=False):
+                 pingtime=10.0, ack_timeout=30.0, send_retries=10,
+                 rate=1.0, burst=3, coalesce=0.5, max_length=4000,
+                 usercache='.slack_users', spool='.slack_spool',
+                 testing=False):
         self.client = SlackClient(token)
-        self.handler = None
+        self.handler = handler
         self.filter_me = filter_me
         self.delay = delay
-        self.pingtime = 10.0
+        self.pingtime = pingtime
         self.lastping = time.time()
+        self.ack_timeout = ack_timeout
+        self.send_retries = send_retries
+        self.rate = rate # posts per second per channel
+        self.burst = burst
+        self.coalesce = coalesce # seconds to wait for more messages to merge
+        self.max_length = max_length # slack truncates longer messages
         self.testing = testing
 
-        if not self.client.rtm_connect():
+        # outbound queue, drained by the sender thread
+        self._outbox = queue.Queue()
+        self._channels = {} # channel: ChannelOutbox, owned by the sender
+        self._pending = {} # message id: (channel, msg, attempt, deadline, spool ids)
+        self._unacked = {} # spool id: number of posts carrying it
+        self._msg_ids = itertools.count(1)
+        self._ack_cond = threading.Condition()
+        self._io_lock = threading.RLock()
+        self._read_lock = threading.Lock()
+
+        # rtm.connect skips downloading the users and channels
+        if not self.client.rtm_connect(with_team_state=False):
             raise Exception('could not connect to slack rtm')
         self.name = self.client.server.username
         self.id = self.client.server.login_data['self']['id']
-        self.usercache = {u.id:(u.real_name if u.real_name else u.name)
-                          for u in self.client.server.users}
+        self.usercache = UserCache(usercache)
+        self._refreshing = set()
+        self.channelcache = {}
+
+        self.spool = None
+        if spool:
+            self.spool = Spool(spool)
+            for spool_id,channel,msg in self.spool.replay():
+                logging.info('resending spooled message to %s: %s', channel, msg)
+                self._unacked[spool_id] = 1
+                self._outbox.put((channel, msg, 0, (spool_id,)))
+
+        self._sender = threading.Thread(target=self._send_loop,
+                                        name='slack-sender')
+        self._sender.daemon = True
+        self._sender.start()
 
     def _client_read(self):
         backoff = 1
         for _ in range(100):
             try:
-                ret = self.client.rtm_read()
+                with self._io_lock:
+                    ret = self.client.rtm_read()
             except Exception:
                 logging.warn('client error - attempting to reconnect')
                 backoff = random.randint(backoff,backoff*2)
                 time.sleep(backoff)
                 try:
-                    self.client.server.rtm_connect(reconnect=True)
+                    self.client.server.rtm_connect(reconnect=True,
+                                                   use_rtm_start=False)
                 except:
                     logging.warn('failed to reconnect')
             else:
@@ -55,17 +385,26 @@ class SlackMessage:
                 return ret
         raise Exception('cannot connect to slack')
 
-    def _client_write(self, channel, msg):
+    def _client_write(self, channel, msg, msg_id=None):
+        data = {
+            'type': 'message',
+            'channel': self.get_channel_id(channel),
+            'text': msg,
+        }
+        if msg_id is not None:
+            data['id'] = msg_id
         backoff = 1
         for _ in range(100):
             try:
-                return self.client.rtm_send_message(channel, msg)
+                with self._io_lock:
+                    return self.client.server.send_to_websocket(data)
             except Exception:
                 logging.warn('client error - attempting to reconnect', exc_info=True)
                 backoff = random.randint(backoff,backoff*2)
                 time.sleep(backoff)
                 try:
-                    self.client.server.rtm_connect(reconnect=True)
+                    self.client.server.rtm_connect(reconnect=True,
+                                                   use_rtm_start=False)
                 except:
                     logging.warn('failed to reconnect')
         raise Exception('cannot connect to slack')
@@ -77,15 +416,38 @@ class SlackMessage:
         if (not self.handler) or not callable(self.handler):
             raise Exception('need a handler defined')
         self.keep_running = True
-        while self.keep_running:
+        with self._read_lock:
+            while self.keep_running:
+                timeout = self.lastping + self.pingtime - time.time()
+                if self._wait_readable(max(timeout, 0)):
+                    self._read_events()
+                self.ping()
+
+    def _wait_readable(self, timeout):
+        """Block until the websocket has data or the timeout expires"""
+        try:
+            sock = self.client.server.websocket.sock
+            if getattr(sock, 'pending', None) and sock.pending():
+                return True # already buffered in the ssl layer
+            r,_,_ = select.select([sock],[],[],timeout)
+        except Exception:
+            # let the read notice the broken connection and reconnect
+            logging.debug('cannot select on websocket', exc_info=True)
+            time.sleep(min(timeout, self.delay))
+            return True
+        return bool(r)
+
+    def _read_events(self):
+        """Read and dispatch everything waiting on the websocket"""
+        while True:
             last_read = self._client_read()
+            if not last_read:
+                break
             while last_read:
                 try:
                     self.dispatch(last_read.pop())
                 except Exception:
                     logging.info('error handling event', exc_info=True)
-            self.ping()
-            time.sleep(self.delay)
 
     def ping(self):
         now = time.time()
@@ -94,36 +456,191 @@ class SlackMessage:
             self.lastping = now
 
     def dispatch(self, event):
-        if 'type' in event and event['type'] == 'message':
-            self.handle_message(event)
+        with profiling.cycle('slack_dispatch'):
+            if 'reply_to' in event:
+                self._ack(event)
+            elif 'type' in event and event['type'] == 'message':
+                self.handle_message(event)
+            elif 'type' in event and event['type'] in ('user_change','team_join'):
+                user = event['user']
+                # changes are kept only for users the bot has seen, so
+                # the cache stays small.  a new user is added, so their
+                # first message does not wait on users.info
+                known_only = event['type'] == 'user_change'
+                self.usercache.update(user['id'], user_display_name(user),
+                                      known_only=known_only)
 
     def send_message(self, channel, msg):
-        logging.info('sending message to %s: %s', channel, msg)
-        # do a read first, to prime the connection
-        last_read = self._client_read()
-        backoff = 10
-        for _ in range(10):
-            self._client_write(channel, msg)
-            time.sleep(10)
-            received = False
-            while not received:
-                last_read = self._client_read()
-                if not last_read:
-                    break
-                for m in last_read:
-                    logging.warn('%r',m)
-                    try: # check that we actually sent it
-                        if parse_slack_message(m['text']) == msg:
-                            received = True
-                            break
-                    except:
-                        pass
-            if not received:
-                logging.warn('client error - failed to send')
-                backoff = random.randint(backoff,backoff*2)
-                time.sleep(backoff)
-                continue
-            break
+        """
+        Queue a message for sending.
+
+        Returns immediately.  The sender thread writes the message and
+        retries it until Slack acknowledges the message id.  Messages to
+        the same channel that are queued close together are merged into
+        one post, and each channel gets at most `rate` posts a second.
+
+        With a spool, the message is on disk before this returns, and
+        is sent again after a restart if it was never acknowledged.
+        """
+        logging.info('queueing message to %s: %s', channel, msg)
+        ids = ()
+        if self.spool:
+            spool_id = self.spool.add(channel, msg)
+            with self._ack_cond:
+                self._unacked[spool_id] = 1
+            ids = (spool_id,)
+        self._outbox.put((channel, msg, 0, ids))
+
+    def flush(self, timeout=None):
+        """
+        Wait for all queued messages to be acknowledged.
+
+        Returns:
+            bool: True if everything was sent
+        """
+        end = None if timeout is None else time.time()+timeout
+        with self._ack_cond:
+            while (self._outbox.unfinished_tasks or self._pending or
+                   any(c.entries for c in self._channels.values())):
+                wait = None if end is None else end-time.time()
+                if wait is not None and wait <= 0:
+                    return False
+                self._ack_cond.wait(wait)
+        return True
+
+    def _ack(self, event):
+        with self._ack_cond:
+            entry = self._pending.pop(event['reply_to'], None)
+            if entry:
+                ack_seconds.observe(time.time()-entry[3]+self.ack_timeout)
+            if entry and not event.get('ok', False):
+                logging.warn('slack rejected message to %s: %r',
+                             entry[0], event.get('error'))
+                self._retry(*entry[:3], ids=entry[4])
+            elif entry:
+                self._finish(entry[4])
+            self._ack_cond.notify_all()
+
+    def _retry(self, channel, msg, attempt, ids=()):
+        if attempt+1 >= self.send_retries:
+            logging.error('giving up sending message to %s: %s', channel, msg)
+            dropped.inc()
+            self._finish(ids)
+        else:
+            retries.inc()
+            self._outbox.put((channel, msg, attempt+1, ids))
+
+    def _finish(self, ids):
+        """Mark spooled messages done once all their posts are finished"""
+        for spool_id in ids:
+            self._unacked[spool_id] -= 1
+            if not self._unacked[spool_id]:
+                del self._unacked[spool_id]
+                if self.spool:
+                    self.spool.done(spool_id)
+
+    def _buffer(self, channel, msg, attempt, ids=()):
+        """Add a message to its channel outbox"""
+        now = time.time()
+        if attempt:
+            backoff = random.randint(2**attempt, 2**(attempt+1))
+            not_before = now+min(backoff, 60)
+        else:
+            not_before = now+self.coalesce
+        with self._ack_cond:
+            if channel not in self._channels:
+                self._channels[channel] = ChannelOutbox(self.rate, self.burst)
+            entries = self._channels[channel].entries
+            parts = split_message(msg, self.max_length)
+            for spool_id in ids:
+                self._unacked[spool_id] += len(parts)-1
+            for part in parts:
+                entries.append((part, attempt, not_before, ids))
+
+    def _next_wakeup(self, now):
+        """Seconds until the sender has something to do, or None"""
+        wake = []
+        with self._ack_cond:
+            if self._pending:
+                deadline = min(p[3] for p in self._pending.values())
+                wake.append(min(max(deadline-now, 0), self.delay))
+            for c in self._channels.values():
+                ready = c.ready_in(now)
+                if ready is not None:
+                    wake.append(ready)
+        return min(wake) if wake else None
+
+    def _send_ready(self):
+        """Post everything whose coalescing window and rate limit allow"""
+        now = time.time()
+        posts = []
+        with self._ack_cond:
+            for channel,c in self._channels.items():
+                while c.ready_in(now) == 0:
+                    msg, attempt, ids = c.take(now, self.max_length)
+                    msg_id = next(self._msg_ids)
+                    self._pending[msg_id] = (channel, msg, attempt,
+                                             now+self.ack_timeout, ids)
+                    posts.append((msg_id, channel, msg))
+        for msg_id, channel, msg in posts:
+            try:
+                logging.info('sending message %d to %s', msg_id, channel)
+                self._client_write(channel, msg, msg_id=msg_id)
+                posts_sent.inc()
+            except Exception:
+                logging.warn('error sending message', exc_info=True)
+
+    def _send_loop(self):
+        """Drain the outbound queue, tracking unacknowledged messages"""
+        while True:
+            # only wake up on a timer while messages wait to go out
+            timeout = self._next_wakeup(time.time())
+
+            with self._ack_cond:
+                pending = bool(self._pending)
+            if pending and self._read_lock.acquire(False):
+                # nobody is running the event loop, so read acks ourselves
+                try:
+                    if self._outbox.empty() and self._wait_readable(timeout):
+                        self._read_events()
+                except Exception:
+                    logging.warn('error reading acks', exc_info=True)
+                finally:
+                    self._read_lock.release()
+                timeout = 0
+
+            try:
+                item = self._outbox.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                while True:
+                    try:
+                        self._buffer(*item)
+                    except Exception:
+                        logging.warn('error queueing message', exc_info=True)
+                    finally:
+                        self._outbox.task_done()
+                    try:
+                        item = self._outbox.get_nowait()
+                    except queue.Empty:
+                        break
+
+            self._send_ready()
+
+            now = time.time()
+            with self._ack_cond:
+                expired = [k for k in self._pending
+                           if self._pending[k][3] < now]
+                for k in expired:
+                    channel, msg, attempt, _, ids = self._pending.pop(k)
+                    logging.warn('no ack for message %d to %s', k, channel)
+                    self._retry(channel, msg, attempt, ids=ids)
+                if expired:
+                    self._ack_cond.notify_all()
+                pending_acks.set(len(self._pending))
+                queue_depth.set(self._outbox.qsize()+sum(len(c.entries)
+                                for c in self._channels.values()))
 
     def handle_message(self, msg):
         reply = None
@@ -135,7 +652,7 @@ class SlackMessage:
                 return
             
             parts = msg['text'].split(':',1)
-            if len(parts) > 2 and (self.name in parts[0] or '<@'+self.id+'>' in parts[0]):
+            if len(parts) == 2 and (self.name in parts[0] or '<@'+self.id+'>' in parts[0]):
                 msg['text'] = parts[1]
             elif self.filter_me:
                 logging.info('filter a message that is not for me')
@@ -150,14 +667,68 @@ class SlackMessage:
             except Exception:
                 logging.warn('error handling message', exc_info=True)
 
-        if reply:
-            self._client_write(msg['channel'], reply)
+        if isinstance(reply, Future):
+            # the handler finishes in the background
+            channel = msg['channel']
+            reply.add_done_callback(lambda f: self._send_result(channel, f))
+        elif reply:
+            self.send_message(msg['channel'], reply)
+
+    def _send_result(self, channel, future):
+        try:
+            reply = future.result()
+        except Exception:
+            logging.warn('error handling message', exc_info=True)
+        else:
+            if reply:
+                self.send_message(channel, reply)
 
     def get_username(self, user_id):
-        if user_id not in self.usercache:
+        """
+        Get the name of a user.
+
+        Only blocks on the slack api for a user never seen before.
+        Stale names are returned as-is and refreshed in the background.
+        """
+        name, stale = self.usercache.get(user_id)
+        if name is None:
+            return self._fetch_user(user_id)
+        if stale and user_id not in self._refreshing:
+            self._refreshing.add(user_id)
+            t = threading.Thread(target=self._fetch_user, args=(user_id,))
+            t.daemon = True
+            t.start()
+        return name
+
+    def _fetch_user(self, user_id):
+        try:
             ret = self.client.api_call('users.info', user=user_id)
-            if ret['user']['real_name']:
-                self.usercache[user_id] = ret['user']['real_name']
-            else:
-                self.usercache[user_id] = ret['user']['name']
-        return self.usercache[user_id]
+            name = user_display_name(ret['user'])
+            self.usercache.update(user_id, name)
+            return name
+        finally:
+            self._refreshing.discard(user_id)
+
+    def get_channel_id(self, channel):
+        """Look up a channel id from a channel name"""
+        channel = channel.lstrip('#')
+        if channel[:1] in ('C','D','G') and channel.isupper():
+            return channel # already an id
+        if channel not in self.channelcache:
+            cursor = None
+            while True:
+                kwargs = {'types':'public_channel,private_channel',
+                          'exclude_archived':True, 'limit':1000}
+                if cursor:
+                    kwargs['cursor'] = cursor
+                ret = self.client.api_call('conversations.list', **kwargs)
+                if not ret.get('ok', False):
+                    raise Exception('cannot list channels: %r'%ret.get('error'))
+                for c in ret['channels']:
+                    self.channelcache[c['name']] = c['id']
+                cursor = ret.get('response_metadata',{}).get('next_cursor')
+                if not cursor:
+                    break
+            if channel not in self.channelcache:
+                raise Exception('unknown channel %r'%channel)
+        return self.channelcache[channel]
@@ -5,16 +5,24 @@ from argparse import ArgumentParser
 
 from setproctitle import setproctitle
 
-def main(testing=False):
+def main(testing=False, metrics_port=None, profile=None):
     from slack import SlackMessage
+    from tickets import TicketHandler
     
     setproctitle('trac_ticket')
 
     logging.basicConfig(level='DEBUG' if testing else 'INFO')
+    if metrics_port:
+        import metrics
+        metrics.serve(metrics_port)
+    if profile:
+        import profiling
+        profiling.enable(profile)
     
     with open('.slack_token') as f:
         token = f.read().strip()
-    slack = SlackMessage(token, testing=testing)
+    slack = SlackMessage(token, handler=TicketHandler(testing=testing),
+                         testing=testing)
     slack.run()
     logging.error('SlackMessage has stopped')
 
@@ -22,6 +30,11 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('--testing', action='store_true',
                         help='testing - do not submit an actual ticket')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve prometheus metrics on this port')
+    parser.add_argument('--profile', nargs='?', const='profiles', default=None,
+                        metavar='DIR', help='profile each cycle, writing to DIR')
 
     args = parser.parse_args()
-    main(testing=args.testing)
+    main(testing=args.testing, metrics_port=args.metrics_port,
+         profile=args.profile)
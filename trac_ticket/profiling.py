@@ -0,0 +1 @@
+../profiling.py
\ No newline at end of file
@@ -0,0 +1,56 @@
+"""
+Slack handler that files trac tickets.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from trac import new_ticket
+import metrics
+import profiling
+
+ticket_seconds = metrics.histogram('trac_ticket_seconds', 'time to make a ticket')
+ticket_errors = metrics.counter('trac_ticket_errors_total', 'failed tickets')
+
+class TicketHandler:
+    """
+    Make a trac ticket out of each message addressed to the bot.
+
+    Tickets are made on a pool of worker threads, so a slow trac
+    does not hold up the slack event loop.  The handler returns a
+    future, and the reply is posted when the ticket is done.
+
+    Args:
+        testing (bool): do not submit an actual ticket
+        workers (int): number of tickets to make at once
+        max_queued (int): number of tickets to accept before refusing more
+    """
+    def __init__(self, testing=False, workers=4, max_queued=32):
+        self.testing = testing
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_queued)
+
+    def __call__(self, text, user=None, channel=None):
+        if not self.slots.acquire(False):
+            logging.warn('ticket queue is full')
+            return 'too many tickets in progress, try again later'
+        try:
+            future = self.pool.submit(self.make_ticket, text, user, channel)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+    def make_ticket(self, text, user=None, channel=None):
+        try:
+            with ticket_seconds.time(), profiling.cycle('trac_ticket'):
+                ticket_url = new_ticket(reporter=user, description=text.strip(),
+                                        dry_run=self.testing)
+        except Exception:
+            logging.warn('error making ticket', exc_info=True)
+            ticket_errors.inc()
+            return 'error occurred'
+        if channel == 'D' and ticket_url:
+            return 'new ticket: '+ticket_url
@@ -3,20 +3,26 @@ Talk with trac over http, just like a normal user.
 """
 
 import os
+import re
 import time
 import logging
+import threading
 from datetime import datetime, timedelta
-from contextlib import contextmanager
 from pprint import pprint
 
 import requests
 
-def get(url, username=None, password=None, session=None, **params):
+import http_client
+
+def get(url, username=None, password=None, session=None, headers=None,
+        **params):
     if not session:
-        session = requests
-    kwargs = {'timeout': 10}
+        session = http_client.session()
+    kwargs = {}
     if username and password:
         kwargs['auth'] = (username, password)
+    if headers:
+        kwargs['headers'] = headers
     if params:
         kwargs['params'] = params
     logging.info('GET for %s, args: %r',url,kwargs)
@@ -26,8 +32,8 @@ def get(url, username=None, password=None, session=None, **params):
 
 def post(url, username=None, password=None, session=None, **params):
     if not session:
-        session = requests
-    kwargs = {'timeout': 10}
+        session = http_client.session()
+    kwargs = {}
     if username and password:
         kwargs['auth'] = (username, password)
     if params:
@@ -38,13 +44,68 @@ def post(url, username=None, password=None, session=None, **params):
     return r
 
 
-@contextmanager
-def start_session(url):
-    s = requests.Session()
-    with open(os.path.join(os.path.dirname(__file__),'.tracauth')) as f:
-        u,p = f.read().split()
-    get(url, username=u, password=p, session=s)
-    yield s
+class TracSession:
+    """
+    A logged in trac session, kept for the life of the process.
+
+    The connection pool, session cookie, and form token are reused
+    for every request.  Login happens on first use, and again if trac
+    rejects a request with 400 (bad form token), 401, or 403.
+
+    Args:
+        url (str): base url of the trac project
+        authfile (str): file with the username and password
+    """
+    def __init__(self, url, authfile=None):
+        if not authfile:
+            authfile = os.path.join(os.path.dirname(__file__),'.tracauth')
+        self.url = url
+        self.authfile = authfile
+        self.session = None
+        self.form_token = None
+        self.lock = threading.Lock()
+
+    def login(self):
+        with open(self.authfile) as f:
+            u,p = f.read().split()
+        s = http_client.new_session()
+        get(self.url+'login', username=u, password=p, session=s)
+        # trac mirrors the form token in a cookie
+        token = s.cookies.get('trac_form_token')
+        if not token:
+            r = get(self.url+'newticket', session=s)
+            text = r.text
+            pos = text.index('form_token=')+12
+            pos2 = text.index('";',pos)
+            token = text[pos:pos2]
+        self.session = s
+        self.form_token = token
+
+    def _get_session(self):
+        with self.lock:
+            if not self.session:
+                self.login()
+            return self.session, self.form_token
+
+    def _expire(self, session):
+        with self.lock:
+            if self.session is session:
+                self.session = None
+                self.form_token = None
+
+    def post(self, page, **data):
+        """POST a form, logging in again if needed"""
+        for attempt in range(2):
+            s, token = self._get_session()
+            data['__FORM_TOKEN'] = token
+            try:
+                return post(self.url+page, session=s, **data)
+            except requests.HTTPError as e:
+                if (attempt or e.response is None or
+                    e.response.status_code not in (400,401,403)):
+                    raise
+                logging.info('trac session expired, logging in again')
+                self._expire(s)
 
 
 TicketConstants = {
@@ -53,8 +114,181 @@ TicketConstants = {
     'component': ['cmake', 'icecube offline', 'icerec', 'infrastructure', 'jeb + pnf', 'other', 'simulation', 'tools/ports'],
 }
 
+class TicketClassifier:
+    """
+    Guess ticket fields from the text of a ticket.
+
+    Built once from the ticket constants.  The text is lowercased once
+    and each keyword is searched for at most once, in order of
+    preference.  A single regex alternation over all keywords was
+    tried, but CPython's substring search beats the regex engine
+    several times over (see benchmarks/trac_classifier.py).
+
+    Args:
+        constants (dict): valid values of the ticket fields
+    """
+    # keywords hinting at a type, used if no type is named directly
+    fallback_types = [
+        ('defect', ['bug','fix','error','broke']),
+        ('enhancement', ['idea','what if','new','feature']),
+        ('cleanup', ['todo','cleanup','clean up']),
+    ]
+
+    def __init__(self, constants=TicketConstants):
+        self.type_rules = [(t,[t]) for t in constants['type']]
+        self.type_rules += self.fallback_types
+        self.priorities = list(constants['priority'])
+        self.components = list(constants['component'])
+        self.valid_components = set(constants['component'])
+        self.value_re = re.compile(r' *([^ ]*)')
+
+    def find_value(self, description, phrases, valid=None):
+        """Get the word after the first phrase found in the description"""
+        for phrase in phrases:
+            pos = description.find(phrase)
+            if pos < 0:
+                continue
+            ret = self.value_re.match(description, pos+len(phrase)).group(1)
+            if valid:
+                ret = ret.lower()
+                if ret not in valid:
+                    continue
+            return ret
+        return None
+
+    def classify(self, summary, description):
+        """
+        Guess the type, priority, component, and owner of a ticket.
+
+        Returns:
+            dict: {field: value}, with None for a field that was not found
+        """
+        text = summary.lower()+description.lower()
+        seen = {}
+        def has(keyword):
+            if keyword not in seen:
+                seen[keyword] = keyword in text
+            return seen[keyword]
+
+        ret = {'type':None, 'priority':None, 'component':None}
+        for value,words in self.type_rules:
+            if any(has(w) for w in words):
+                ret['type'] = value
+                break
+        for value in self.priorities:
+            if has(value):
+                ret['priority'] = value
+                break
+        for value in self.components:
+            if has(value):
+                ret['component'] = value
+                break
+        else:
+            ret['component'] = self.find_value(description,
+                    ['component:','component to'], valid=self.valid_components)
+        ret['owner'] = self.find_value(description, ['owner:','owner to'])
+        return ret
+
+classifier = TicketClassifier()
+
 base_url = 'http://code.icecube.wisc.edu/projects/icecube/'
 
+trac_session = TracSession(base_url)
+
+class UserDirectory:
+    """
+    Cached copy of the trac user directory.
+
+    The directory is downloaded on first use.  After `ttl` seconds
+    it is refreshed in the background with a conditional GET, while
+    lookups keep using the old copy.
+
+    Args:
+        url (str): address of the trac subjects page
+        ttl (float): seconds before the directory is refreshed
+    """
+    def __init__(self, url, ttl=3600):
+        self.url = url
+        self.ttl = ttl
+        self.by_name = {}
+        self.by_username = {}
+        self.etag = None
+        self.last_modified = None
+        self.updated = None
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def refresh(self):
+        """Download the directory, if it changed"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        try:
+            r = get(self.url, headers=headers)
+            if r.status_code != 304:
+                by_name = {}
+                for line in r.text.split('\n'):
+                    parts = line.split('|')
+                    name = ' '.join(parts[-1].split())
+                    if name:
+                        by_name[name] = parts[0]
+                by_username = {u:n for n,u in by_name.items()}
+                with self.lock:
+                    self.by_name = by_name
+                    self.by_username = by_username
+                    self.etag = r.headers.get('ETag')
+                    self.last_modified = r.headers.get('Last-Modified')
+            else:
+                logging.debug('user directory not modified')
+            self.updated = time.time()
+        finally:
+            self.refreshing = False
+
+    def _check(self):
+        if self.updated is None:
+            self.refresh()
+        elif self.updated+self.ttl < time.time() and not self.refreshing:
+            self.refreshing = True
+            t = threading.Thread(target=self._background_refresh)
+            t.daemon = True
+            t.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            logging.warn('error refreshing user directory', exc_info=True)
+
+    def users(self):
+        """
+        Get the names/usernames for trac
+
+        Returns:
+            dict: {real name: username}
+        """
+        self._check()
+        return self.by_name
+
+    def username(self, name):
+        """Convert a real name to a username, if known"""
+        self._check()
+        with self.lock:
+            return self.by_name.get(name, name)
+
+    def real_name(self, username):
+        """Convert a username to a real name, if known"""
+        self._check()
+        with self.lock:
+            return self.by_username.get(username, username)
+
+    def usernames(self, names):
+        """Convert a comma-separated list of names to usernames"""
+        return ','.join(self.username(n) for n in names.split(',') if n)
+
+user_directory = UserDirectory(os.path.join(base_url,'subjects'))
+
 def get_users():
     """
     Get a list of names/usernames for trac
@@ -62,14 +296,7 @@ def get_users():
     Returns:
         dict: {real name: username}
     """
-    r = get(os.path.join(base_url,'subjects'))
-    users = {}
-    for line in r.text.split('\n'):
-        parts = line.split('|')
-        name = ' '.join(parts[-1].split())
-        if name:
-            users[name] = parts[0]
-    return users
+    return user_directory.users()
 
 def new_ticket(summary=None, reporter='icecube', description=None,
                type=None, priority=None, milestone=None,
@@ -83,64 +310,25 @@ def new_ticket(summary=None, reporter='icecube', description=None,
     if not description:
         description = summary
         
-    users = get_users()
-    if reporter in users:
-        reporter = users[reporter]
+    reporter = user_directory.username(reporter)
 
-    def locate(phrases):
-        s = summary.lower()+description.lower()
-        return any(p in s for p in phrases)
-
-    def find_phrase(phrases, valid=None):
-        for phrase in phrases:
-            pos = description.find(phrase)
-            if pos >= 0:
-                pos += len(phrase)
-                while pos < len(description) and description[pos] == ' ':
-                    pos += 1
-                pos2 = description.find(' ',pos)
-                if pos2 > 0:
-                    ret = description[pos:pos2]
-                else:
-                    ret = description[pos:]
-                if valid:
-                    ret = ret.lower()
-                    if ret not in valid:
-                        continue
-                return ret
-        raise Exception('phrases not found')
+    guess = classifier.classify(summary, description)
 
     if type:
         type = type.lower()
         if type not in TicketConstants['type']:
             raise Exception('invalid type')
     else:
-        type = 'rumor / allegation'
-        for t in TicketConstants['type']:
-            if locate([t]):
-                type = t
-                break
-        else:
-            if locate(['bug','fix','error','broke']):
-                type = 'defect'
-            elif locate(['idea','what if','new','feature']):
-                type = 'enhancement'
-            elif locate(['todo','cleanup','clean up']):
-                type = 'cleanup'
+        type = guess['type'] or 'rumor / allegation'
 
     if priority:
         priority = priority.lower()
         if priority not in TicketConstants['priority']:
             raise Exception('invalid priority')
+    elif guess['priority']:
+        priority = guess['priority']
     else:
-        priority = 'normal'
-        for p in TicketConstants['priority']:
-            if locate([p]):
-                priority = p
-                break
-        else:
-            if type == 'defect':
-                priority = 'major'
+        priority = 'major' if type == 'defect' else 'normal'
 
     if not milestone:
         d = datetime.now()+timedelta(days=1)
@@ -151,51 +339,27 @@ def new_ticket(summary=None, reporter='icecube', description=None,
         if component not in TicketConstants['component']:
             raise Exception('invalid component')
     else:
-        component = 'icerec'
-        for c in TicketConstants['component']:
-            if locate([c]):
-                component = c
-                break
-        else:
-            try:
-                component = find_phrase(['component:','component to'],
-                                        valid=TicketConstants['component'])
-            except Exception:
-                pass
-    
+        component = guess['component'] or 'icerec'
+
     if not owner:
-        try:
-            owner = find_phrase(['owner:','owner to'])
-        except Exception:
-            pass
-    if owner in users:
-        owner = users[owner]
+        owner = guess['owner'] or ''
+    owner = user_directory.username(owner)
 
-    cc = ','.join(users[c] if c in users else c for c in cc.split(',') if c)
+    cc = user_directory.usernames(cc)
  
-    with start_session(base_url+'login') as s:
-        # get form token
-        r = get(base_url+'newticket', session=s)
-        text = r.text
-        pos = text.index('form_token=')+12
-        pos2 = text.index('";',pos)
-        token = text[pos:pos2]
-
-        data = {
-            '__FORM_TOKEN': token,
-            'field_summary': summary,
-            'field_reporter': reporter,
-            'field_description': description,
-            'field_type': type,
-            'field_priority': priority,
-            'field_milestone': milestone,
-            'field_component': component,
-            'field_keywords': keywords,
-            'field_owner': owner,
-        }
-        pprint(data)
-        
-        if not dry_run:
-            r = post(base_url+'newticket', session=s, **data)
-            return r.url
+    data = {
+        'field_summary': summary,
+        'field_reporter': reporter,
+        'field_description': description,
+        'field_type': type,
+        'field_priority': priority,
+        'field_milestone': milestone,
+        'field_component': component,
+        'field_keywords': keywords,
+        'field_owner': owner,
+    }
+    pprint(data)
 
+    if not dry_run:
+        r = trac_session.post('newticket', **data)
+        return r.url
@@ -0,0 +1 @@
+../json_store.py
\ No newline at end of file
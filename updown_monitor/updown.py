@@ -1,33 +1,77 @@
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
+from http_cache import PageCache
+import metrics
+import profiling
 
 logger = logging.getLogger('updown')
 
-def monitor(servers, delay=60, failure_thresh=5):
+pages = PageCache()
+server_up = metrics.gauge('updown_up', '1 if the last probe of a server worked')
+
+def probe(server, timeout=None):
+    """
+    Check a single server.
+
+    The request is conditional, so an unchanged page costs a 304
+    instead of the whole body.
+
+    Args:
+        server (str): address of the server
+        timeout (int): request timeout, or None for the http_client default
+
+    Returns:
+        bool: True if the server is up
+    """
+    try:
+        with profiling.cycle('updown_probe'):
+            body = pages.fetch(server, verify=False, timeout=timeout)
+            for _ in body or ():
+                pass # read it all, so the connection can be reused
+    except:
+        logger.warn('error getting server page %s', server, exc_info=True)
+        return False
+    return True
+
+def monitor(servers, delay=60, failure_thresh=5, workers=32):
     """
     Monitor a set of servers.
-    
+
+    All servers are probed in parallel, so a cycle takes about as long
+    as the slowest probe.  If a cycle runs past `delay`, the missed
+    checks are skipped instead of run back to back.
+
     Args:
         servers (list): list of dicts to monitor/send
         delay (int): sleep delay between checks
         failure_thresh (int): number of page failures before error
+        workers (int): max number of concurrent probes
     """
     for s in servers:
         s['failures'] = 0
-    while True:
-        start = time.time()
-        for s in servers:
-            try:
-                r = requests.get(s['server'], verify=False, timeout=10)
-                r.raise_for_status()
-            except:
-                logger.warn('error getting server page', exc_info=True)
-                s['failures'] += 1
-                if s['failures'] == failure_thresh:
-                    s['send'](s['server']+' is down')
-            else:
-                s['failures'] = 0
-
-        time.sleep(delay-(time.time()-start))
+    workers = max(1, min(workers, len(servers)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        next_cycle = time.time()
+        while True:
+            start = time.time()
+            with profiling.cycle('updown'):
+                results = pool.map(probe, [s['server'] for s in servers])
+                for s,ok in zip(servers, results):
+                    server_up.set(int(ok), server=s['server'])
+                    if ok:
+                        s['failures'] = 0
+                        continue
+                    s['failures'] += 1
+                    if s['failures'] == failure_thresh:
+                        s['send'](s['server']+' is down')
+
+            next_cycle += delay
+            now = time.time()
+            if next_cycle < now:
+                skipped = int((now-next_cycle)//delay)+1
+                logger.warn('cycle took %.1f seconds, skipping %d check(s)',
+                            now-start, skipped)
+                next_cycle += skipped*delay
+            time.sleep(next_cycle-now)